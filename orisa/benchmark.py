@@ -0,0 +1,363 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Benchmark for the handle sync pipeline.
+
+Seeds a database with users, handles and SR history, then runs a full sync cycle
+(_sync_handles -> _fetch_sr -> _apply_sr -> _handle_new_sr -> _update_nick) against
+a fake SR source and a fake Discord client.
+
+Run it with `python -m orisa.benchmark --database-uri URI`. The database must be
+empty, it will be filled with test data. It should be of the same type as the
+DATABASE_URI in config.py, because that decides whether queries run in threads.
+"""
+import argparse
+import functools
+import logging
+import random
+import resource
+import time
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import trio
+
+from sqlalchemy import bindparam, event
+
+from .config import GuildConfig
+from .fake_blizzard import generate_competitive_rank
+from .models import Database, Handle, Role, SR, User
+from .orisa import Orisa, SYNC_BATCH_SIZE, SYNC_BATCH_WORKERS
+from .utils import CareerProfile, SRSource, set_sr_source
+from .exceptions import BlizzardError
+
+
+class FakeSRSource(SRSource):
+    def __init__(self, *, latency, change_rate, error_rate):
+        self.latency = latency
+        self.change_rate = change_rate
+        self.error_rate = error_rate
+
+    async def fetch_profile(self, handle, validators):
+        await trio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            raise BlizzardError("got status code 503 from Blizz")
+        generation = 1 if random.random() < self.change_rate else 0
+        return CareerProfile(
+            validators, headers={}, fragment=_fragment(handle.handle, generation)
+        )
+
+
+def _fragment(battle_tag, generation):
+    return generate_competitive_rank("pc", battle_tag, generation).encode()
+
+
+class FakeNickname:
+    def __init__(self, member, latency):
+        self.member = member
+        self.latency = latency
+
+    async def set(self, nick):
+        await trio.sleep(self.latency)
+        self.member.name = nick
+
+
+class FakeMember:
+    def __init__(self, id, guild_id, latency):
+        self.id = id
+        self.guild_id = guild_id
+        self.name = f"user{id}"
+        self.nickname = FakeNickname(self, latency)
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+        self.name = f"guild{id}"
+        self.members = {}
+
+
+class FakeMessages:
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeChannel:
+    def __init__(self):
+        self.messages = FakeMessages()
+
+
+class FakeUser:
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeClient:
+    def __init__(self, guilds):
+        self.guilds = {guild.id: guild for guild in guilds}
+        self._channel = FakeChannel()
+
+    def find_channel(self, id):
+        return self._channel
+
+    async def get_user(self, id):
+        return FakeUser()
+
+
+def seed(database, options):
+    "Fills the database, returns the discord IDs of the users"
+    now = datetime.utcnow()
+    session = database.Session()
+    try:
+        if session.query(User.id).first():
+            raise SystemExit("The database is not empty, refusing to seed it")
+
+        user_rows = []
+        handle_rows = []
+        sr_rows = []
+        current_srs = []
+        handle_id = sr_id = 0
+        for user_id in range(1, options.users + 1):
+            user_rows.append(
+                dict(id=user_id, discord_id=user_id, format="$sr", roles=Role.NONE)
+            )
+            for position in range(options.handles_per_user):
+                handle_id += 1
+                battle_tag = f"User{user_id}#{position}"
+                handle_rows.append(
+                    dict(
+                        id=handle_id,
+                        type="battletag",
+                        user_id=user_id,
+                        position=position,
+                        error_count=0,
+                        battle_tag=battle_tag,
+                        blizzard_id=handle_id,
+                        next_sync_at=now,
+                        # as if the profile had been fetched before, so that
+                        # unchanged profiles are detected
+                        profile_hash=CareerProfile(
+                            None, fragment=_fragment(battle_tag, 0)
+                        ).fragment_hash,
+                    )
+                )
+                for age in reversed(range(options.history)):
+                    sr_id += 1
+                    sr_rows.append(
+                        dict(
+                            id=sr_id,
+                            handle_id=handle_id,
+                            timestamp=now - timedelta(hours=2 * (age + 1)),
+                            tank=random.randint(500, 4500),
+                            damage=random.randint(500, 4500),
+                            support=random.randint(500, 4500),
+                        )
+                    )
+                if options.history:
+                    current_srs.append(dict(handle_id=handle_id, sr_id=sr_id))
+
+        def insert_all(table, rows):
+            for start in range(0, len(rows), 10000):
+                session.execute(table.insert(), rows[start : start + 10000])
+
+        insert_all(User.__table__, user_rows)
+        insert_all(Handle.__table__, handle_rows)
+        insert_all(SR.__table__, sr_rows)
+
+        table = Handle.__table__
+        update = (
+            table.update()
+            .where(table.c.id == bindparam("handle_id"))
+            .values(current_sr_id=bindparam("sr_id"))
+        )
+        for start in range(0, len(current_srs), 10000):
+            session.execute(update, current_srs[start : start + 10000])
+
+        if database.engine.dialect.name == "postgresql":
+            # the IDs were given explicitly, so the sequences need to catch up
+            for table in ("users", "handle", "srs"):
+                session.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"(SELECT max(id) FROM {table}))"
+                )
+
+        session.commit()
+    finally:
+        session.close()
+
+    # the tables were empty when the database was opened
+    database._fill_peak_ranks()
+    database._fill_last_srs()
+
+    return [row["discord_id"] for row in user_rows]
+
+
+class Stats:
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.queries = 0
+
+    def timed(self, stage, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.durations[stage].append(time.perf_counter() - start)
+
+        return wrapper
+
+    def timed_sync(self, stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.durations[stage].append(time.perf_counter() - start)
+
+        return wrapper
+
+    def count_query(self, *args):
+        self.queries += 1
+
+
+async def run(options):
+    database = Database(options.database_uri)
+
+    print(
+        f"seeding {options.users} users with {options.handles_per_user} handles and "
+        f"{options.history} SRs each…"
+    )
+    discord_ids = seed(database, options)
+
+    guilds = [FakeGuild(id) for id in range(1, options.guilds + 1)]
+    for discord_id in discord_ids:
+        for guild in random.sample(guilds, min(options.guilds_per_user, len(guilds))):
+            guild.members[discord_id] = FakeMember(
+                discord_id, guild.id, options.discord_latency
+            )
+
+    orisa = Orisa(FakeClient(guilds), database, None)
+    for guild in guilds:
+        orisa._index_guild_members(guild)
+        config = GuildConfig.default()
+        config.congrats_channel_id = 1
+        orisa.guild_config[guild.id] = config
+
+    set_sr_source(
+        FakeSRSource(
+            latency=options.sr_latency,
+            change_rate=options.change_rate,
+            error_rate=options.error_rate,
+        )
+    )
+
+    stats = Stats()
+    for stage in ("_sync_handles", "_fetch_sr", "_handle_new_sr", "_update_nick"):
+        setattr(orisa, stage, stats.timed(stage, getattr(orisa, stage)))
+    orisa._apply_sr = stats.timed_sync("_apply_sr", orisa._apply_sr)
+    event.listen(database.engine, "before_cursor_execute", stats.count_query)
+
+    async with database.session() as session:
+        schedule = await database.get_sync_schedule(session)
+    handle_ids = [handle_id for _, handle_id in sorted(schedule)]
+
+    print(f"syncing {len(handle_ids)} handles…")
+    stats.queries = 0
+    start = time.perf_counter()
+
+    send_ch, receive_ch = trio.open_memory_channel(0)
+    # tasks Orisa spawns (like the nickname writers) are part of the sync
+    async with trio.open_nursery() as spawned:
+
+        async def spawn(func, *args):
+            spawned.start_soon(func, *args)
+
+        orisa.spawn = spawn
+
+        async with trio.open_nursery() as nursery:
+            async with receive_ch:
+                for _ in range(SYNC_BATCH_WORKERS):
+                    nursery.start_soon(
+                        orisa._sync_handles_from_channel, receive_ch.clone()
+                    )
+            async with send_ch:
+                for batch_start in range(0, len(handle_ids), SYNC_BATCH_SIZE):
+                    await send_ch.send(
+                        handle_ids[batch_start : batch_start + SYNC_BATCH_SIZE]
+                    )
+
+    elapsed = time.perf_counter() - start
+
+    print()
+    print(f"handles/sec:        {len(handle_ids) / elapsed:10.1f}")
+    print(f"DB queries/handle:  {stats.queries / len(handle_ids):10.2f}")
+    print(
+        f"peak RSS:           {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:10.1f} MB"
+    )
+    print()
+    print(f"{'stage':<16}{'calls':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for stage, durations in stats.durations.items():
+        p50, p99 = np.percentile(durations, [50, 99]) * 1000
+        print(f"{stage:<16}{len(durations):>8}{p50:>10.2f}{p99:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--database-uri", required=True, help="URI of an empty database"
+    )
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--handles-per-user", type=int, default=1)
+    parser.add_argument(
+        "--history", type=int, default=50, help="SR history rows per handle"
+    )
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--guilds-per-user", type=int, default=2)
+    parser.add_argument(
+        "--sr-latency",
+        type=float,
+        default=0.0,
+        help="seconds the fake SR source takes per request",
+    )
+    parser.add_argument(
+        "--discord-latency",
+        type=float,
+        default=0.0,
+        help="seconds a fake nickname update takes",
+    )
+    parser.add_argument(
+        "--change-rate",
+        type=float,
+        default=0.3,
+        help="fraction of handles whose SR changed",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument(
+        "--verbose", action="store_true", help="show Orisa's log output"
+    )
+    options = parser.parse_args()
+
+    # the simulated errors would drown out the results otherwise
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.CRITICAL)
+
+    trio.run(run, options)
+
+
+if __name__ == "__main__":
+    main()
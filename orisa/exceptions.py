@@ -25,6 +25,10 @@ class UnableToFindSR(RuntimeError):
     pass
 
 
+class ProfileUnchanged(RuntimeError):
+    pass
+
+
 class NicknameTooLong(RuntimeError):
     def __init__(self, nickname):
         self.nickname = nickname
@@ -0,0 +1,176 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""A server imitating playoverwatch.com's career pages, for load testing.
+
+Run it with `python -m orisa.fake_blizzard` and set BLIZZARD_BASE_URL in config.py
+to point to it. Recorded career pages can be put into a directory as
+<platform>/<handle>.html (with # replaced by -); handles without a recording get
+one of the other recordings, or a generated page if there are none.
+"""
+import argparse
+import hashlib
+import logging
+import random
+
+from pathlib import Path
+
+import hypercorn.config
+import hypercorn.trio
+import trio
+
+from quart import Response, request
+from quart_trio import QuartTrio
+
+logger = logging.getLogger(__name__)
+
+app = QuartTrio(__name__)
+
+# set by main()
+options = None
+recordings = {}
+
+# how often a generated profile has been changed, to simulate people playing
+_generation = {}
+
+_ROLE_TEMPLATE = (
+    '<div class="competitive-rank-role">'
+    '<div class="competitive-rank-role-icon"></div>'
+    '<div class="competitive-rank-tier competitive-rank-tier-tooltip" data-ow-tooltip-text="{role} Skill Rating">'
+    '<img class="competitive-rank-tier-icon" src="https://example.com/rank-{rank}.png">'
+    "</div>"
+    '<div class="competitive-rank-level">{sr}</div>'
+    "</div>"
+)
+
+
+def generate_competitive_rank(platform, handle, generation=0):
+    "Returns a competitive-rank div with random, but deterministic SRs"
+    rnd = random.Random(f"{platform}/{handle}/{generation}")
+    roles = "".join(
+        _ROLE_TEMPLATE.format(role=role, sr=sr, rank=sr // 500)
+        for role, sr in (
+            (role, rnd.randint(500, 4500)) for role in ("Tank", "Damage", "Support")
+        )
+        if rnd.random() < 0.8
+    )
+    return f'<div class="competitive-rank">{roles}</div>'
+
+
+def _generated_page(platform, handle):
+    key = (platform, handle)
+    if random.random() < options.change_rate:
+        _generation[key] = _generation.get(key, 0) + 1
+
+    return (
+        f"<!DOCTYPE html><html><head><title>{handle}</title></head><body>"
+        f'<div class="masthead"><h1 class="header-masthead">{handle}</h1>'
+        f"{generate_competitive_rank(platform, handle, _generation.get(key, 0))}</div>"
+        # the real pages are several hundred KB, most of it after the SR
+        f'<div class="career-stats">{"x" * options.page_size}</div>'
+        "</body></html>"
+    ).encode()
+
+
+def _page(platform, handle):
+    try:
+        return recordings[(platform, handle)]
+    except KeyError:
+        pass
+
+    if recordings:
+        pages = list(recordings.values())
+        return pages[int(hashlib.sha1(handle.encode()).hexdigest(), 16) % len(pages)]
+
+    return _generated_page(platform, handle)
+
+
+@app.route("/en-us/career/<string:platform>/<string:handle>")
+async def career(platform, handle):
+    await trio.sleep(max(0, random.gauss(options.latency, options.latency_stddev)))
+
+    rnd = random.random()
+    if rnd < options.error_rate:
+        return Response("Service Unavailable", status=503)
+    rnd -= options.error_rate
+    if rnd < options.rate_limit_rate:
+        return Response("Too Many Requests", status=429)
+    rnd -= options.rate_limit_rate
+    if rnd < options.not_found_rate:
+        return Response(
+            "<html><body><h1>Profile Not Found</h1></body></html>", status=200
+        )
+
+    page = _page(platform, handle)
+    etag = '"' + hashlib.sha1(page).hexdigest() + '"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response("", status=304, headers={"ETag": etag})
+
+    return Response(page, status=200, headers={"ETag": etag}, content_type="text/html")
+
+
+def _load_recordings(directory):
+    for path in Path(directory).glob("*/*.html"):
+        recordings[(path.parent.name, path.stem)] = path.read_bytes()
+    logger.info("loaded %d recorded career pages", len(recordings))
+
+
+def main():
+    global options
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--bind", default="127.0.0.1:8081")
+    parser.add_argument("--pages", help="directory with recorded career pages")
+    parser.add_argument(
+        "--latency", type=float, default=0.5, help="mean response time in seconds"
+    )
+    parser.add_argument("--latency-stddev", type=float, default=0.2)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.01, help="fraction of 503 responses"
+    )
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=0.0, help="fraction of 429 responses"
+    )
+    parser.add_argument(
+        "--not-found-rate",
+        type=float,
+        default=0.01,
+        help='fraction of "Profile Not Found" responses',
+    )
+    parser.add_argument(
+        "--change-rate",
+        type=float,
+        default=0.1,
+        help="probability that a generated profile has a new SR on each request",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=300_000,
+        help="size of the padding after the SR in generated pages",
+    )
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if options.pages:
+        _load_recordings(options.pages)
+
+    config = hypercorn.config.Config()
+    config.bind = [options.bind]
+    trio.run(hypercorn.trio.serve, app, config)
+
+
+if __name__ == "__main__":
+    main()
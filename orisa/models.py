@@ -12,12 +12,14 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
 import random
 import typing
 
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from enum import Flag, auto
+from itertools import groupby
 
 import trio
 
@@ -25,25 +27,45 @@ from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     SmallInteger,
     String,
     create_engine,
+    desc,
     func,
+    inspect,
+    literal,
+    or_,
+    select,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.orm import raiseload, relationship, sessionmaker
+from sqlalchemy.orm import (
+    joinedload,
+    raiseload,
+    relationship,
+    sessionmaker,
+    with_polymorphic,
+)
 import sqlalchemy.types as types
 
-from .config import DATABASE_URI
+from .config import (
+    DATABASE_URI,
+    LEADERBOARD_RETENTION_DAYS,
+    SR_HISTORY_DAILY_AFTER_DAYS,
+    SR_HISTORY_RETENTION_DAYS,
+    SR_HISTORY_WEEKLY_AFTER_DAYS,
+)
 from .utils import sr_to_rank, TDS, run_sync
 from .i18n import _, N_, NP_
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -112,6 +134,14 @@ class User(Base):
 
     always_show_sr = Column(Boolean, nullable=False, default=False)
 
+    peak_ranks = relationship(
+        "PeakRank", back_populates="user", cascade="all, delete-orphan"
+    )
+
+    leaderboard_entries = relationship(
+        "LeaderboardEntry", back_populates="user", cascade="all, delete-orphan"
+    )
+
     def __repr__(self):
         return f"<User(id={self.id}, discord_id={self.discord_id})>"
 
@@ -147,6 +177,19 @@ class Handle(Base):
 
     error_count = Column(Integer, nullable=False, default=0)
 
+    # the last SRs that weren't None, they are shown as old SRs in nicknames
+    last_tank = Column(SmallInteger)
+    last_damage = Column(SmallInteger)
+    last_support = Column(SmallInteger)
+    next_sync_at = Column(DateTime)
+    # when the profile was last fetched successfully, changed or not
+    last_checked_at = Column(DateTime)
+
+    # used to detect unchanged career profiles without parsing them
+    profile_etag = Column(String)
+    profile_last_modified = Column(String)
+    profile_hash = Column(String)
+
     __mapper_args__ = {"polymorphic_on": type}
 
     @property
@@ -157,22 +200,41 @@ class Handle(Base):
     def rank(self):
         return self.current_sr.ranks if self.current_sr else None
 
+    @property
+    def last_sr(self):
+        return TDS(self.last_tank, self.last_damage, self.last_support)
+
     @property
     def last_update(self):
+        if self.last_checked_at:
+            return self.last_checked_at
         return self.current_sr.timestamp if self.current_sr else None
 
-    def update_sr(self, new_srs, *, timestamp=None):
+    def update_sr(self, new_srs, *, timestamp=None, recent=None):
+        """Adds new_srs to the history, or updates the latest entry if the last two are identical.
+
+        recent can be given as the two most recent SRs (newest first) if they are already known,
+        to avoid querying them.
+
+        Returns the user's peak SRs for this handle type from before the update."""
         if timestamp is None:
             timestamp = datetime.utcnow()
 
         if new_srs is None:
             new_srs = TDS(None, None, None)
 
-        if (
-            len(self.sr_history[:2]) > 1
-            and self.sr_history[0].values == self.sr_history[1].values
-        ):
-            sr_obj = self.sr_history[0]
+        if recent is None:
+            recent = self.sr_history[:2]
+
+        if recent and recent[0].values == new_srs:
+            # nothing new, so the peaks cannot have changed either. This avoids
+            # loading them on every failed sync
+            previous_peaks = TDS(None, None, None)
+        else:
+            previous_peaks = self._update_peak_ranks(new_srs)
+
+        if len(recent) > 1 and recent[0].values == recent[1].values:
+            sr_obj = recent[0]
             sr_obj.timestamp = timestamp
             sr_obj.values = new_srs
         else:
@@ -188,6 +250,28 @@ class Handle(Base):
 
         self.current_sr = sr_obj
 
+        for role, sr in zip(TDS._fields, new_srs):
+            if sr is not None:
+                setattr(self, f"last_{role}", sr)
+
+        return previous_peaks
+
+    def _update_peak_ranks(self, new_srs):
+        peaks = {
+            peak.role: peak for peak in self.user.peak_ranks if peak.type == self.type
+        }
+        previous_peaks = []
+        for role, sr in enumerate(new_srs):
+            peak = peaks.get(role)
+            previous_peaks.append(peak.sr if peak else None)
+            if sr is None:
+                continue
+            if peak is None:
+                self.user.peak_ranks.append(PeakRank(type=self.type, role=role, sr=sr))
+            elif sr > peak.sr:
+                peak.sr = sr
+        return TDS(*previous_peaks)
+
     def __repr__(self):
         return f"<Handle(id={self.id})>"
 
@@ -296,9 +380,22 @@ class OnlineID(Handle):
 
 class SR(Base):
     __tablename__ = "srs"
+    __table_args__ = (
+        # all history lookups are "latest n SRs of a handle". The SRs are part of
+        # the index, so that those can be answered by an index only scan
+        Index(
+            "ix_srs_handle_id_timestamp",
+            "handle_id",
+            desc("timestamp"),
+            "id",
+            "tank",
+            "damage",
+            "support",
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    handle_id = Column(Integer, ForeignKey("handle.id"), nullable=False, index=True)
+    handle_id = Column(Integer, ForeignKey("handle.id"), nullable=False)
 
     handle = relationship(
         "Handle",
@@ -329,6 +426,40 @@ class SR(Base):
         return f"<SR(id={self.id}, values={self.values})>"
 
 
+class PeakRank(Base):
+    "The highest SR a user ever had in a role, over all handles of one type"
+    __tablename__ = "peak_ranks"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    type = Column(String, primary_key=True)
+    # index into TDS
+    role = Column(SmallInteger, primary_key=True)
+    sr = Column(SmallInteger, nullable=False)
+
+    user = relationship("User", back_populates="peak_ranks")
+
+    def __repr__(self):
+        return f"<PeakRank(user_id={self.user_id}, type={self.type}, role={self.role}, sr={self.sr})>"
+
+
+class LeaderboardEntry(Base):
+    "A user's place in the daily leaderboard snapshot of one platform and role"
+    __tablename__ = "leaderboard_entries"
+
+    date = Column(Date, primary_key=True)
+    type = Column(String, primary_key=True)
+    # "tank", "damage" or "support"
+    role = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    sr = Column(SmallInteger, nullable=False)
+    position = Column(Integer, nullable=False)
+
+    user = relationship("User", back_populates="leaderboard_entries")
+
+    def __repr__(self):
+        return f"<LeaderboardEntry(date={self.date}, type={self.type}, role={self.role}, user_id={self.user_id}, sr={self.sr})>"
+
+
 class GuildConfigJson(Base):
     __tablename__ = "guild_configs"
 
@@ -346,16 +477,190 @@ class WelcomeMessage(Base):
     guild_name = Column(String)
 
 
+def _history_bucket(sr, now):
+    "SRs in the same bucket are thinned out to the latest one"
+    age = now - sr.timestamp
+    if SR_HISTORY_WEEKLY_AFTER_DAYS is not None and age > timedelta(
+        days=SR_HISTORY_WEEKLY_AFTER_DAYS
+    ):
+        return sr.timestamp.isocalendar()[:2]
+    elif SR_HISTORY_DAILY_AFTER_DAYS is not None and age > timedelta(
+        days=SR_HISTORY_DAILY_AFTER_DAYS
+    ):
+        return sr.timestamp.date()
+    else:
+        return sr.id
+
+
+def _redundant_srs(srs, now):
+    """Returns the IDs of SRs that can be deleted from a handle's history.
+
+    srs must be ordered by timestamp. Runs of identical SRs are reduced to their
+    first and last entry (which is what update_sr would have written), old
+    SRs are downsampled according to the config. The current SR and the one
+    before it are always kept, update_sr needs them."""
+    keep = {sr.id for sr in srs[-2:]} | {srs[0].current_sr_id}
+
+    if SR_HISTORY_RETENTION_DAYS is not None:
+        cutoff = now - timedelta(days=SR_HISTORY_RETENTION_DAYS)
+        expired = [sr.id for sr in srs if sr.timestamp < cutoff and sr.id not in keep]
+    else:
+        expired = []
+    expired_ids = set(expired)
+
+    sampled = [
+        sr
+        for sr, next_sr in zip(srs, srs[1:] + [None])
+        if sr.id not in expired_ids
+        and (
+            next_sr is None
+            or sr.id in keep
+            or _history_bucket(sr, now) != _history_bucket(next_sr, now)
+        )
+    ]
+    sampled_ids = {sr.id for sr in sampled}
+    thinned = [
+        sr.id for sr in srs if sr.id not in sampled_ids and sr.id not in expired_ids
+    ]
+
+    values = [(sr.tank, sr.damage, sr.support) for sr in sampled]
+    collapsed = [
+        sr.id
+        for ix, sr in enumerate(sampled)
+        if 0 < ix < len(sampled) - 1
+        and values[ix - 1] == values[ix] == values[ix + 1]
+        and sr.id not in keep
+    ]
+
+    return expired + thinned + collapsed
+
+
 class Database:
-    def __init__(self):
-        if DATABASE_URI.startswith("sqlite://"):
-            engine = create_engine(DATABASE_URI)
+    def __init__(self, uri=DATABASE_URI):
+        if uri.startswith("sqlite://"):
+            engine = create_engine(uri)
         else:
-            engine = create_engine(DATABASE_URI, pool_size=20, max_overflow=10)
+            engine = create_engine(uri, pool_size=20, max_overflow=10)
+        self.engine = engine
         self.Session = sessionmaker(bind=engine, autoflush=False)
         Base.metadata.create_all(engine)
-
-        self._min_delay = min(self._sync_delay(x) for x in range(10))
+        self._add_missing_columns()
+        self._create_missing_indexes()
+        self._fill_peak_ranks()
+        self._fill_last_srs()
+
+    def _add_missing_columns(self):
+        "create_all doesn't add new columns to existing tables"
+        inspector = inspect(self.engine)
+        quote = self.engine.dialect.identifier_preparer.quote
+        for table in Base.metadata.tables.values():
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(
+                        f"column {table.name}.{column.name} is missing and must be added manually"
+                    )
+                logger.warning(f"adding missing column {table.name}.{column.name}")
+                column_type = column.type.compile(dialect=self.engine.dialect)
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        f"ALTER TABLE {quote(table.name)} "
+                        f"ADD COLUMN {quote(column.name)} {column_type}"
+                    )
+
+    def _create_missing_indexes(self):
+        "create_all only creates indexes of new tables"
+        inspector = inspect(self.engine)
+        postgresql = self.engine.dialect.name == "postgresql"
+        if postgresql:
+            # left behind by a CREATE INDEX CONCURRENTLY that failed
+            invalid = {
+                name
+                for name, in self.engine.execute(
+                    "SELECT c.relname FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+                )
+            }
+        else:
+            invalid = set()
+
+        for table in Base.metadata.tables.values():
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing and index.name not in invalid:
+                    continue
+                logger.warning(
+                    f"creating missing index {index.name}, this can take a while…"
+                )
+                with self.engine.connect() as conn:
+                    if postgresql:
+                        # don't lock out writes to the table while the index is built.
+                        # This can't run inside a transaction
+                        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                        if index.name in invalid:
+                            conn.execute(f"DROP INDEX CONCURRENTLY {index.name}")
+                        index.dialect_kwargs["postgresql_concurrently"] = True
+                    index.create(conn)
+
+    def _fill_peak_ranks(self):
+        "Computes the peak ranks from the SR history, if the table was just created"
+        with self.engine.begin() as conn:
+            if conn.execute(select([PeakRank.user_id]).limit(1)).first():
+                return
+
+            for role, column in enumerate((SR.tank, SR.damage, SR.support)):
+                conn.execute(
+                    PeakRank.__table__.insert().from_select(
+                        ["user_id", "type", "role", "sr"],
+                        select(
+                            [
+                                Handle.user_id,
+                                Handle.type,
+                                literal(role, SmallInteger),
+                                func.max(column),
+                            ]
+                        )
+                        .select_from(
+                            SR.__table__.join(
+                                Handle.__table__, SR.handle_id == Handle.id
+                            )
+                        )
+                        .where(column.isnot(None))
+                        .group_by(Handle.user_id, Handle.type),
+                    )
+                )
+
+    def _fill_last_srs(self):
+        "Sets the last SRs of the handles from the SR history, if the columns were just added"
+        table = Handle.__table__
+        with self.engine.begin() as conn:
+            if conn.execute(
+                select([table.c.id])
+                .where(
+                    or_(
+                        table.c.last_tank.isnot(None),
+                        table.c.last_damage.isnot(None),
+                        table.c.last_support.isnot(None),
+                    )
+                )
+                .limit(1)
+            ).first():
+                return
+
+            values = {}
+            for role in TDS._fields:
+                column = SR.__table__.c[role]
+                values[f"last_{role}"] = (
+                    select([column])
+                    .where(SR.handle_id == table.c.id)
+                    .where(column.isnot(None))
+                    .order_by(desc(SR.timestamp))
+                    .limit(1)
+                    .as_scalar()
+                )
+            conn.execute(table.update().values(**values))
 
     @asynccontextmanager
     async def session(self):
@@ -371,15 +676,124 @@ class Database:
     async def handle_by_id(self, session, id):
         return await run_sync(session.query(Handle).filter_by(id=id).one_or_none)
 
+    async def handles_by_ids(self, session, ids):
+        # load the columns of all handle types, the handles are used outside
+        # of the transaction by the sync
+        handle = with_polymorphic(Handle, "*")
+        return await run_sync(
+            session.query(handle)
+            .options(joinedload(handle.user).selectinload(User.peak_ranks))
+            .filter(handle.id.in_(ids))
+            .all
+        )
+
+    async def get_recent_srs(self, session, handle_ids, count=2):
+        "Returns a dict of handle id to the handle's count most recent SRs, newest first"
+        row_number = (
+            func.row_number()
+            .over(partition_by=SR.handle_id, order_by=desc(SR.timestamp))
+            .label("row_number")
+        )
+        numbered = (
+            session.query(SR.id, row_number)
+            .filter(SR.handle_id.in_(handle_ids))
+            .subquery()
+        )
+        srs = await run_sync(
+            session.query(SR)
+            .join(numbered, SR.id == numbered.c.id)
+            .filter(numbered.c.row_number <= count)
+            .order_by(SR.handle_id, desc(SR.timestamp))
+            .all
+        )
+        return {
+            handle_id: list(handle_srs)
+            for handle_id, handle_srs in groupby(srs, key=lambda sr: sr.handle_id)
+        }
+
+    async def take_leaderboard_snapshot(self, session, date):
+        "Stores the current ranking of all primary handles as the leaderboard of date"
+        await run_sync(session.query(LeaderboardEntry).filter_by(date=date).delete)
+
+        for role in ("tank", "damage", "support"):
+            sr = getattr(SR, role)
+            await run_sync(
+                session.execute,
+                LeaderboardEntry.__table__.insert().from_select(
+                    ["date", "type", "role", "user_id", "sr", "position"],
+                    select(
+                        [
+                            literal(date, Date),
+                            Handle.type,
+                            literal(role, String),
+                            Handle.user_id,
+                            sr,
+                            func.row_number().over(
+                                partition_by=Handle.type, order_by=desc(sr)
+                            ),
+                        ]
+                    )
+                    .select_from(
+                        Handle.__table__.join(
+                            SR.__table__, Handle.current_sr_id == SR.id
+                        )
+                    )
+                    .where(Handle.position == 0)
+                    .where(sr.isnot(None)),
+                ),
+            )
+
+        await run_sync(
+            session.query(LeaderboardEntry)
+            .filter(
+                LeaderboardEntry.date
+                < date - timedelta(days=LEADERBOARD_RETENTION_DAYS)
+            )
+            .delete
+        )
+
+    async def has_leaderboard_snapshot(self, session, date):
+        entry = await run_sync(
+            session.query(LeaderboardEntry.date).filter_by(date=date).first
+        )
+        return entry is not None
+
+    async def get_previous_leaderboard_date(self, session, date):
+        return await run_sync(
+            session.query(func.max(LeaderboardEntry.date))
+            .filter(LeaderboardEntry.date < date)
+            .scalar
+        )
+
+    async def get_leaderboard(self, session, date, discord_ids):
+        """Returns the leaderboard entries of date for the given users, best first.
+
+        The result is a list of (entry, discord_id) tuples"""
+        discord_ids = list(discord_ids)
+        entries = []
+        for start in range(0, len(discord_ids), 5000):
+            entries += await run_sync(
+                session.query(LeaderboardEntry, User.discord_id)
+                .join(User, LeaderboardEntry.user_id == User.id)
+                .filter(LeaderboardEntry.date == date)
+                .filter(User.discord_id.in_(discord_ids[start : start + 5000]))
+                .all
+            )
+        entries.sort(key=lambda row: row[0].position)
+        return entries
+
     async def user_by_discord_id(self, session, discord_id):
         return await run_sync(
             session.query(User).filter_by(discord_id=discord_id).one_or_none
         )
 
     async def get_srs(self, session, discord_ids):
+        "Returns (discord_id, tank, damage, support) of the primary handles' current SRs"
         return await run_sync(
-            session.query(SR)
-            .join(Handle.current_sr, User)
+            session.query(User.discord_id, SR.tank, SR.damage, SR.support)
+            .select_from(Handle)
+            .join(Handle.current_sr)
+            .join(Handle.user)
             .filter(Handle.position == 0)
             .filter(User.discord_id.in_(discord_ids))
             .all
@@ -405,23 +819,76 @@ class Database:
         else:
             return timedelta(days=1)
 
-    async def get_handles_to_be_synced(self, session):
-        results = await run_sync(
-            session.query(Handle)
+    def schedule_sync(self, handle):
+        "Sets next_sync_at according to the handle's error count"
+        handle.next_sync_at = datetime.utcnow() + self._sync_delay(handle.error_count)
+
+    async def get_sync_schedule(self, session):
+        "Returns (next_sync_at, handle_id) tuples for all handles"
+        scheduled = await run_sync(
+            session.query(Handle.next_sync_at, Handle.id)
+            .filter(Handle.next_sync_at.isnot(None))
+            .all
+        )
+
+        # handles that have never been synced since next_sync_at was introduced
+        unscheduled = await run_sync(
+            session.query(Handle.id, Handle.error_count, SR.timestamp)
             .outerjoin(Handle.current_sr)
-            .filter(
-                coalesce(SR.timestamp, datetime.min)
-                <= datetime.utcnow() - self._min_delay
-            )
+            .filter(Handle.next_sync_at.is_(None))
             .all
         )
+
+        return [tuple(row) for row in scheduled] + [
+            (
+                last_update + self._sync_delay(error_count)
+                if last_update
+                else datetime.min,
+                id,
+            )
+            for id, error_count, last_update in unscheduled
+        ]
+
+    async def get_handle_ids(self, session):
         return [
-            result.id
-            for result in results
-            if (result.last_update or datetime.min)
-            <= datetime.utcnow() - self._sync_delay(result.error_count)
+            id
+            for id, in await run_sync(session.query(Handle.id).order_by(Handle.id).all)
         ]
 
+    async def compact_sr_history(self, session, handle_ids, now=None):
+        "Deletes redundant SRs of the given handles, returns the number of deleted SRs"
+        if now is None:
+            now = datetime.utcnow()
+
+        rows = await run_sync(
+            session.query(
+                SR.id,
+                SR.handle_id,
+                SR.timestamp,
+                SR.tank,
+                SR.damage,
+                SR.support,
+                Handle.current_sr_id,
+            )
+            .join(Handle, SR.handle_id == Handle.id)
+            .filter(SR.handle_id.in_(handle_ids))
+            .order_by(SR.handle_id, SR.timestamp)
+            .all
+        )
+
+        to_delete = []
+        for handle_id, srs in groupby(rows, key=lambda row: row.handle_id):
+            to_delete.extend(_redundant_srs(list(srs), now))
+
+        for start in range(0, len(to_delete), 1000):
+            await run_sync(
+                session.query(SR)
+                .filter(SR.id.in_(to_delete[start : start + 1000]))
+                .delete,
+                False,  # synchronize_session
+            )
+        return len(to_delete)
+
     async def get_welcome_message(self, session, message_id):
         msg = await run_sync(
             session.query(WelcomeMessage).filter_by(id=message_id).one_or_none
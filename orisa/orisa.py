@@ -17,6 +17,7 @@ import logging.config
 
 import csv
 import functools
+import heapq
 import math
 import re
 import random
@@ -26,7 +27,6 @@ import time
 import traceback
 import unicodedata
 import urllib.parse
-import warnings
 
 from contextlib import contextmanager, nullcontext, suppress
 from contextvars import ContextVar
@@ -78,9 +78,9 @@ from fuzzywuzzy import process, fuzz
 from lxml import html
 from oauthlib.oauth2 import WebApplicationClient
 from pandas.plotting import register_matplotlib_converters
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql import func, desc, and_
+from sqlalchemy.sql import and_
 from trio.to_thread import run_sync
 from itsdangerous.url_safe import URLSafeTimedSerializer
 from itsdangerous.exc import BadSignature
@@ -109,8 +109,6 @@ from .models import (
     User,
     BattleTag,
     Gamertag,
-    Handle,
-    SR,
     OnlineID,
     Role,
     GuildConfigJson,
@@ -119,6 +117,7 @@ from .models import (
 from .exceptions import (
     BlizzardError,
     InvalidBattleTag,
+    ProfileUnchanged,
     UnableToFindSR,
     NicknameTooLong,
     InvalidFormat,
@@ -126,6 +125,7 @@ from .exceptions import (
 from .i18n import _, N_, ngettext, CurrentLocale, locale_by_flag
 from .utils import (
     get_sr,
+    SR_REQUESTS,
     sort_secondaries,
     send_long,
     reply,
@@ -146,6 +146,18 @@ VOTE_LINK = "https://discordbots.org/bot/445905377712930817/vote"
 DONATE_LINK = "https://ko-fi.com/R5R2PC36"
 TRANSLATE_LINK = "https://hosted.weblate.org/engage/orisa/"
 
+# how many handles are synced and committed together
+SYNC_BATCH_SIZE = 50
+SYNC_BATCH_WORKERS = 3
+
+SR_COMPACTION_BATCH_SIZE = 500
+
+# how many guilds get their highscores posted at the same time
+HIGHSCORE_POST_CONCURRENCY = 10
+
+# voice events for a category within that many seconds are handled together
+VOICE_ADJUST_DELAY = 2
+
 RANKS = (
     # Translators: 2 letter code for "Bronze" rank
     N_("Br"),
@@ -237,12 +249,105 @@ class ChannelRenameLimit:
 
 
 # Main Orisa code
+def _sr_str(val, short=False):
+    "Formats an SR for nicknames, negative SRs are old ones"
+    if val is None:
+        return "⊘"
+    elif val < 0:
+        return f"{int(-val//100):02}?" if short else f"{-val:4}?"
+    else:
+        return f"{int(val//100,):02}" if short else f"{val:4}"
+
+
+def _sr_rank(val, short=False):
+    if val is None:
+        return "⊘"
+    elif val < 0:
+        return (RANKS if short else FULL_RANKS)[sr_to_rank(-val)] + "?"
+    else:
+        return (RANKS if short else FULL_RANKS)[sr_to_rank(val)]
+
+
+def _all_srs_str(srs, *, short):
+    return "-".join(_sr_str(x, short=short) for x in srs)
+
+
+def _all_ranks_str(srs, *, short):
+    return "-".join(_sr_rank(x, short=short) for x in srs)
+
+
+def _role_sr_str(symbol, role, srs):
+    return symbol + _sr_str(getattr(srs, role))
+
+
+def _role_rank_str(symbol, role, srs):
+    return symbol + _sr_rank(getattr(srs, role))
+
+
+@functools.lru_cache(maxsize=4096)
+def _nick_template(format):
+    "Returns the compiled Template of a nickname format and the placeholders it uses"
+    template = Template(format)
+    placeholders = {
+        match.group("named") or match.group("braced")
+        for match in template.pattern.finditer(format)
+        if match.group("named") or match.group("braced")
+    }
+    return template, placeholders
+
+
+@functools.lru_cache(maxsize=None)
+def _highscore_texts(type_class, role, locale):
+    "Returns the introduction and table headers of a highscore, locale must be the current locale"
+    intro = _(
+        "Hello! Here are the current SRs for **{role}** on {platform}. If a member has more than one "
+        "{handle_type}, only the primary {handle_type} is considered. Players with "
+        "private profiles, or those that didn't do their placements this season yet "
+        "are not shown."
+    ).format(
+        role=_(role.capitalize()),
+        platform=type_class.blizzard_url_type.upper(),
+        handle_type=_(type_class.desc),
+    )
+    headers = [
+        # Translators: header for highscore table: position (keep it short)
+        _("#"),
+        # Translators: header for highscore table: previous position (keep it short)
+        _("prev"),
+        # Translators: header for highscore table: member name
+        _("Member"),
+        # Translators: header for highscore table: member discord id
+        _("Member ID"),
+        # Translators: header fdor highscore table: SR
+        _("{role} SR").format(role=_(role.capitalize())),
+        # Translators: header for highscore table: SR difference
+        _("ΔSR"),
+    ]
+    return intro, headers
+
+
 class Orisa(Plugin):
 
     SYMBOL_DPS = "\N{CROSSED SWORDS}"
     SYMBOL_TANK = "\N{SHIELD}"
     SYMBOL_SUPPORT = "\N{HEAVY GREEK CROSS}"
 
+    # functions that format the SRs for the placeholders of nickname formats
+    NICK_PLACEHOLDERS = {
+        "sr": functools.partial(_all_srs_str, short=True),
+        "fullsr": functools.partial(_all_srs_str, short=False),
+        "rank": functools.partial(_all_ranks_str, short=True),
+        "fullrank": functools.partial(_all_ranks_str, short=False),
+        "dps": functools.partial(_role_sr_str, SYMBOL_DPS, "damage"),
+        "dpsrank": functools.partial(_role_rank_str, SYMBOL_DPS, "damage"),
+        "damage": functools.partial(_role_sr_str, SYMBOL_DPS, "damage"),
+        "damagerank": functools.partial(_role_rank_str, SYMBOL_DPS, "damage"),
+        "tank": functools.partial(_role_sr_str, SYMBOL_TANK, "tank"),
+        "tankrank": functools.partial(_role_rank_str, SYMBOL_TANK, "tank"),
+        "support": functools.partial(_role_sr_str, SYMBOL_SUPPORT, "support"),
+        "supportrank": functools.partial(_role_rank_str, SYMBOL_SUPPORT, "support"),
+    }
+
     # dirty hack needed for correct_channel condition
     _instance = None
 
@@ -256,11 +361,37 @@ class Orisa(Plugin):
         self.sync_cache = cachetools.TTLCache(maxsize=1000, ttl=30)
         self.stopped_playing_cache = cachetools.TTLCache(maxsize=1000, ttl=10)
 
+        # heap of (next_sync_at, handle_id), entries that don't match
+        # _sync_due are stale and will be skipped
+        self._sync_queue = []
+        self._sync_due = {}
+        self._sync_queue_changed = trio.Event()
+        self._leaderboard_snapshot_lock = trio.Lock()
+
+        # discord user id -> ids of the guilds they're in, see _member_guilds
+        self._guild_ids_by_member = defaultdict(set)
+
+        # like _sync_queue, but for posting highscores
+        self._cron_queue = []
+        self._cron_due = {}
+        self._cron_queue_changed = trio.Event()
+
         self.guild_config = defaultdict(GuildConfig.default)
 
         self._new_channel_name = {}
+        # ids of voice categories that need to be adjusted, see _queue_voice_adjustment
+        self._dirty_voice_categories = set()
+        self._voice_adjusters = set()
         self._channel_rename_limit = cachetools.LRUCache(maxsize=1000)
 
+        # guild id -> {member id: (member, nick)} of nicknames yet to be set
+        self._pending_nicks = defaultdict(dict)
+        self._nick_writers = set()
+        # (guild id, member id) -> nick we set, until Discord tells us about it
+        self._recent_nicks = cachetools.TTLCache(maxsize=10000, ttl=60)
+        # discord user id -> {locale: (formatted nick, always_show_sr)}, see _forget_nick
+        self._nick_cache = cachetools.LRUCache(maxsize=10000)
+
         self._welcome_language = cachetools.LRUCache(maxsize=500)
 
         # Translators: sent by Orisa when she joins a new server
@@ -291,6 +422,9 @@ class Orisa(Plugin):
                     config.config
                 )
 
+        for guild in self.client.guilds.values():
+            self._index_guild_members(guild)
+
         logger.warn("TEMPORARILY NOT SENDING MESSAGES TO GUILDS!")
         # await self.spawn(self._message_new_guilds)
 
@@ -299,6 +433,10 @@ class Orisa(Plugin):
         logger.info("spawning cron")
         await self.spawn(self._cron_task)
 
+        await self.spawn(self._compact_sr_history_task)
+
+        await self.spawn(self._leaderboard_snapshot_task)
+
         await self.spawn(self._web_server)
 
         await self.spawn(self._oauth_result_listener)
@@ -986,6 +1124,7 @@ class Orisa(Plugin):
             removed.current_sr_id = None
             handle = removed.handle
             await run_sync(session.commit)
+            self._forget_nick(user.discord_id)
             await reply(ctx, _("Removed **{handle}**!").format(handle=handle))
             await self._update_nick_after_secondary_change(ctx, user)
 
@@ -1054,6 +1193,7 @@ class Orisa(Plugin):
                 t.position = i + 1
 
             await run_sync(session.commit)
+            self._forget_nick(user.discord_id)
 
             await reply(
                 ctx,
@@ -1146,6 +1286,7 @@ Pornography Historian"""
                         ).format(new_nick=new_nick, title=random.choice(titles)),
                     )
             await run_sync(session.commit)
+            self._forget_nick(user.discord_id)
 
     @ow.subcommand(aliases=("alwayshowsr",))
     @condition(correct_channel)
@@ -1159,6 +1300,7 @@ Pornography Historian"""
             user.always_show_sr = new_setting
             await self._update_nick(user)
             await run_sync(session.commit)
+            self._forget_nick(user.discord_id)
 
         msg = "Done. "
         if new_setting:
@@ -1208,6 +1350,10 @@ Pornography Historian"""
                         ).format(sr=user.handles[0].sr),
                     )
             await run_sync(session.commit)
+            if user:
+                for handle in user.handles:
+                    self._push_sync(handle.id, handle.next_sync_at)
+            self._forget_nick(ctx.author.id)
 
     @ow.subcommand()
     async def forgetme(self, ctx):
@@ -1217,11 +1363,8 @@ Pornography Historian"""
                 logger.info(f"{ctx.author.name} ({ctx.author.id}) requested removal")
                 user_id = user.discord_id
                 try:
-                    for guild in self._configured_guilds():
-                        try:
-                            nn = str(guild.members[user_id].name)
-                        except KeyError:
-                            continue
+                    for guild in self._member_guilds(user_id):
+                        nn = str(guild.members[user_id].name)
                         new_nn = re.sub(r"\s*\[.*?\]", "", nn, count=1).strip()
                         try:
                             await guild.members[user_id].nickname.set(new_nn)
@@ -1235,6 +1378,7 @@ Pornography Historian"""
                     _("OK, deleted {name} from database").format(name=ctx.author.name),
                 )
                 await run_sync(session.commit)
+                self._forget_nick(user_id)
             else:
                 await reply(
                     ctx,
@@ -1357,10 +1501,9 @@ Pornography Historian"""
                 channel_id = g_conf.listen_channel_id
 
         if not channel_id:
-            for guild in self._configured_guilds():
-                if ctx.author.id in guild.members:
-                    channel_id = self.guild_config[guild.id].listen_channel_id
-                    break
+            for guild in self._member_guilds(ctx.author.id):
+                channel_id = self.guild_config[guild.id].listen_channel_id
+                break
 
         embed = Embed(
             title=_("Orisa's purpose"),
@@ -1836,41 +1979,28 @@ Pornography Historian"""
 
     @event("voice_state_update")
     async def _voice_state_update(self, ctx, member, old_voice_state, new_voice_state):
-        parent = None
-        if old_voice_state and old_voice_state.channel:
-            parent = old_voice_state.channel.parent
-            if parent:
-                try:
-                    await self._adjust_voice_channels(parent)
-                except Exception:
-                    logger.warn(
-                        f"Can't adjust voice channel for parent {parent}", exc_info=True
-                    )
-
-        if new_voice_state and new_voice_state.channel:
-            if new_voice_state.channel.parent != parent:
-                if new_voice_state.channel.parent:
-                    try:
-                        await self._adjust_voice_channels(
-                            new_voice_state.channel.parent
-                        )
-                    except Exception:
-                        logger.warn(
-                            f"Can't adjust voice channel for new state parent {new_voice_state.channel.parent}",
-                            exc_info=True,
-                        )
+        for voice_state in (old_voice_state, new_voice_state):
+            if voice_state and voice_state.channel and voice_state.channel.parent:
+                await self._queue_voice_adjustment(voice_state.channel.parent)
+
+        locale = self.guild_config[member.guild_id].locale
+        CurrentLocale.set(locale)
+        cached = self._nick_cache.get(member.id, {}).get(locale)
+        if cached is None:
+            async with self.database.session() as session:
+                user = await self.database.user_by_discord_id(session, member.id)
+                if not user:
+                    return
+                cached = (self._format_nick(user), user.always_show_sr)
+                self._nick_cache.setdefault(member.id, {})[locale] = cached
 
-        CurrentLocale.set(self.guild_config[member.guild_id].locale)
-        async with self.database.session() as session:
-            user = await self.database.user_by_discord_id(session, member.id)
-            if user:
-                formatted = self._format_nick(user)
-                try:
-                    await self._update_nick_for_member(member, formatted)
-                except Exception:
-                    logger.warn(
-                        "Unable to update nick for member %s", member, exc_info=True
-                    )
+        formatted, always_show_sr = cached
+        try:
+            await self._update_nick_for_member(
+                member, formatted, always_show_sr=always_show_sr
+            )
+        except Exception:
+            logger.warn("Unable to update nick for member %s", member, exc_info=True)
 
     @event("message_create")
     async def _message_create(self, ctx, msg):
@@ -1889,6 +2019,7 @@ Pornography Historian"""
             guild,
             len(self.client.guilds),
         )
+        self._unindex_guild_members(guild)
         async with self.database.session() as session:
             gc = session.query(GuildConfigJson).filter_by(id=guild.id).one_or_none()
             if gc:
@@ -1898,6 +2029,7 @@ Pornography Historian"""
             if cron:
                 logger.info("That guild had a cron configured")
                 session.delete(cron)
+                self._schedule_highscores(guild.id, None)
             with suppress(KeyError):
                 del self.guild_config[guild.id]
             await run_sync(session.commit)
@@ -1913,12 +2045,13 @@ Pornography Historian"""
             await self._guild_leave(ctx, member.guild)
             return
         else:
+            self._guild_ids_by_member[member.id].discard(member.guild.id)
             async with self.database.session() as session:
                 user = await self.database.user_by_discord_id(session, member.id)
                 if user:
                     in_other_guild = False
-                    for guild in self.client.guilds.values():
-                        if guild.id != member.guild.id and member.id in guild.members:
+                    for guild in self._member_guilds(member.id, configured=False):
+                        if guild.id != member.guild.id:
                             in_other_guild = True
                             logger.debug(f"{member.name} is still in guild {guild.id}")
                             break
@@ -1928,6 +2061,7 @@ Pornography Historian"""
                         )
                         session.delete(user)
                         await run_sync(session.commit)
+                        self._forget_nick(member.id)
 
     @event("gateway_dispatch_received")
     async def _gw_dispatch_received(
@@ -1974,14 +2108,28 @@ Pornography Historian"""
     @event("guild_join")
     async def _guild_joined(self, ctx: Context, guild: Guild):
         logger.info("Joined guild %r", guild)
+        self._index_guild_members(guild)
         await self._handle_new_guild(guild)
 
     @event("guild_streamed")
     async def _guild_streamed(self, ctx, guild):
         logger.info("Streamed guild %r", guild)
+        self._index_guild_members(guild)
         if guild.id not in self.guild_config:
             await self._handle_new_guild(guild)
 
+    @event("guild_chunk")
+    async def _guild_chunk(self, ctx, guild, member_count):
+        self._index_guild_members(guild)
+
+    @event("guild_available")
+    async def _guild_available(self, ctx, guild):
+        self._index_guild_members(guild)
+
+    @event("guild_member_add")
+    async def _guild_member_add(self, ctx, member: Member):
+        self._guild_ids_by_member[member.id].add(member.guild_id)
+
     async def _handle_new_guild(self, guild):
         logger.info(
             r"We have a new guild %s, I'm now on %d guilds \o/",
@@ -2102,6 +2250,39 @@ Pornography Historian"""
 
     # Util
 
+    async def _queue_voice_adjustment(self, parent):
+        """
+        Adjusts the channels of a voice category soon. There is at most one adjustment
+        per category and VOICE_ADJUST_DELAY; it uses the state at the time it runs,
+        so events that arrive in the meantime are covered by it.
+        """
+        category_id = parent.id
+        self._dirty_voice_categories.add(category_id)
+        if category_id in self._voice_adjusters:
+            return
+
+        async def adjust():
+            try:
+                while category_id in self._dirty_voice_categories:
+                    await trio.sleep(VOICE_ADJUST_DELAY)
+                    self._dirty_voice_categories.discard(category_id)
+                    parent = self.client.find_channel(category_id)
+                    if not parent:
+                        logger.debug("voice category %d is gone", category_id)
+                        continue
+                    try:
+                        await self._adjust_voice_channels(parent)
+                    except Exception:
+                        logger.warn(
+                            f"Can't adjust voice channel for parent {parent}",
+                            exc_info=True,
+                        )
+            finally:
+                self._voice_adjusters.discard(category_id)
+
+        self._voice_adjusters.add(category_id)
+        await self.spawn(adjust)
+
     async def _adjust_voice_channels(
         self, parent, *, create_all_channels=False, adjust_user_limits=False
     ):
@@ -2247,56 +2428,30 @@ Pornography Historian"""
 
             final_list = []
 
-            async def channel_suffix(session, chan):
-                srs = await self.database.get_srs(
-                    session, [member.id for member in chan.voice_members if member]
+            if cat.show_sr_in_nicks:
+                suffixes = await self._voice_channel_suffixes(
+                    [chan for prefix in prefix_map for chan in managed_group[prefix]]
                 )
-
-                combined = np.array([sr.values for sr in srs], dtype=np.float)
-
-                if not any(x is not None for x in combined):
-                    return ""
-
-                # hide useless warning in case we take the mean of an empty slice
-                with warnings.catch_warnings():
-
-                    tds_filtered_mean = [
-                        0
-                        if np.all(np.isnan(x))
-                        else np.nanmean(x[np.abs(x - np.nanmean(x)) <= 750])
-                        for x in combined.T
-                    ]
-
-                def val(x):
-                    return (
-                        "xx" if np.isnan(x) else "⊘" if x == 0 else f"{int(x//100):02}"
-                    )
-
-                return f" [{'-'.join(val(x) for x in tds_filtered_mean)}]"
+            else:
+                suffixes = {}
 
             for prefix, prefix_info in prefix_map.items():
                 chans = managed_group[prefix]
                 # rename channels if necessary
-                async with self.database.session() as session:
-                    for i, chan in enumerate(chans):
-                        if cat.show_sr_in_nicks:
-                            new_name = (
-                                f"{prefix} #{i+1}{await channel_suffix(session, chan)}"
-                            )
-                        else:
-                            new_name = f"{prefix} #{i+1}"
+                for i, chan in enumerate(chans):
+                    new_name = f"{prefix} #{i+1}{suffixes.get(chan.id, '')}"
 
-                        try:
-                            await self._rename_channel(chan, new_name)
-                            if adjust_user_limits:
-                                limit = prefix_info.limit
-                                await chan.edit(user_limit=limit)
-                        except NotFound:
-                            logger.warn(
-                                "Tried to change a channel that Discord says does not exist, removing it from cache!",
-                                exc_info=True,
-                            )
-                            chan.guild._channels.pop(chan.id, None)
+                    try:
+                        await self._rename_channel(chan, new_name)
+                        if adjust_user_limits:
+                            limit = prefix_info.limit
+                            await chan.edit(user_limit=limit)
+                    except NotFound:
+                        logger.warn(
+                            "Tried to change a channel that Discord says does not exist, removing it from cache!",
+                            exc_info=True,
+                        )
+                        chan.guild._channels.pop(chan.id, None)
 
                 final_list.extend(chans)
 
@@ -2325,6 +2480,61 @@ Pornography Historian"""
                         )
                         chan.guild._channels.pop(chan.id, None)
 
+    async def _voice_channel_suffixes(self, chans):
+        """
+        Returns the " [tank-damage-support]" suffix of every channel with registered
+        members, by channel id. All channels are handled with a single query.
+        """
+        channel_idx = {
+            member.id: i
+            for i, chan in enumerate(chans)
+            for member in chan.voice_members
+            if member
+        }
+        if not channel_idx:
+            return {}
+
+        async with self.database.session() as session:
+            srs = await self.database.get_srs(session, list(channel_idx.keys()))
+        if not srs:
+            return {}
+
+        # one row per member, missing SRs are NaN
+        groups = np.array([channel_idx[discord_id] for discord_id, *_ in srs])
+        values = np.array([sr for _, *sr in srs], dtype=float)
+
+        def channel_means(mask):
+            "mean per channel and role of the values where mask is True"
+            sums = np.zeros((len(chans), 3))
+            counts = np.zeros((len(chans), 3))
+            np.add.at(sums, groups, np.where(mask, values, 0))
+            np.add.at(counts, groups, mask)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return sums / counts, counts
+
+        means, counts = channel_means(~np.isnan(values))
+        # ignore outliers; NaN never compares as near
+        with np.errstate(invalid="ignore"):
+            near = np.abs(values - means[groups]) <= 750
+        filtered_means, _ = channel_means(near)
+        # nobody in the channel has an SR for that role
+        filtered_means[counts == 0] = 0
+
+        def val(x):
+            return "xx" if np.isnan(x) else "⊘" if x == 0 else f"{int(x//100):02}"
+
+        return {
+            chans[i].id: f" [{'-'.join(val(x) for x in filtered_means[i])}]"
+            for i in np.unique(groups)
+        }
+
+    def _forget_nick(self, user_id):
+        """
+        Drops the cached nicks of a user. Must be called after everything _format_nick
+        or _show_sr_in_nick depends on has been changed and committed.
+        """
+        self._nick_cache.pop(user_id, None)
+
     def _format_nick(self, user):
         primary = user.handles[0]
 
@@ -2333,66 +2543,25 @@ Pornography Historian"""
         else:
             all_sr = TDS(None, None, None)
 
-        if any(x is None for x in all_sr):
-            # normally, we only save different values for SR, so if there is
-            # a non null value, it should be the second or third, but just
-            # to be sure, check the first 10...
-            # negative value means it's an old one
-            for old_sr in primary.sr_history[:10]:
-                if old_sr.values:
-                    all_sr = TDS(
-                        *[av or (ov and -ov) for av, ov in zip(all_sr, old_sr.values)]
-                    )
-                if all(x is not None for x in all_sr):
-                    break
+        # negative value means it's an old one
+        all_sr = TDS(*[av or (ov and -ov) for av, ov in zip(all_sr, primary.last_sr)])
 
         has_secondaries = len(user.handles) > 1
 
-        def val_str(val, short=False):
-            if val is None:
-                return "⊘"
-            elif val < 0:
-                return f"{int(-val//100):02}?" if short else f"{-val:4}?"
-            else:
-                return f"{int(val//100,):02}" if short else f"{val:4}"
-
-        def val_rank(val, short=False):
-            if val is None:
-                return "⊘"
-            elif val < 0:
-                return (RANKS if short else FULL_RANKS)[sr_to_rank(-val)] + "?"
-            else:
-                return (RANKS if short else FULL_RANKS)[sr_to_rank(val)]
-
-        sr_str = "-".join(val_str(x, short=True) for x in all_sr)
-        rank_str = "-".join(val_rank(x, short=True) for x in all_sr)
-        full_sr_str = "-".join(val_str(x) for x in all_sr)
-        full_rank_str = "-".join(val_rank(x) for x in all_sr)
-
         if has_secondaries:
             sec_mark = "*"
         else:
             sec_mark = ""
 
-        t = Template(user.format)
+        t, placeholders = _nick_template(user.format)
+        # only compute what the format actually uses
+        values = {
+            name: self.NICK_PLACEHOLDERS[name](all_sr)
+            for name in placeholders
+            if name in self.NICK_PLACEHOLDERS
+        }
         try:
-            return (
-                t.substitute(
-                    sr=sr_str,
-                    fullsr=full_sr_str,
-                    rank=rank_str,
-                    fullrank=full_rank_str,
-                    dps=self.SYMBOL_DPS + val_str(all_sr.damage),
-                    dpsrank=self.SYMBOL_DPS + val_rank(all_sr.damage),
-                    damage=self.SYMBOL_DPS + val_str(all_sr.damage),
-                    damagerank=self.SYMBOL_DPS + val_rank(all_sr.damage),
-                    tank=self.SYMBOL_TANK + val_str(all_sr.tank),
-                    tankrank=self.SYMBOL_TANK + val_rank(all_sr.tank),
-                    support=self.SYMBOL_SUPPORT + val_str(all_sr.support),
-                    supportrank=self.SYMBOL_SUPPORT + val_rank(all_sr.support),
-                )
-                + sec_mark
-            )
+            return t.substitute(values) + sec_mark
         except KeyError as e:
             raise InvalidFormat(e.args[0]) from e
 
@@ -2475,11 +2644,8 @@ Pornography Historian"""
         user_id = user.discord_id
         exception = new_nn = None
 
-        for guild in self._configured_guilds():
-            try:
-                member = guild.members[user_id]
-            except KeyError:
-                continue
+        for guild in self._member_guilds(user_id):
+            member = guild.members[user_id]
             try:
                 CurrentLocale.set(self.guild_config[guild.id].locale)
                 formatted = self._format_nick(user)
@@ -2507,10 +2673,11 @@ Pornography Historian"""
         *,
         force=False,
         raise_hierachy_error=False,
+        always_show_sr=None,
     ):
         nn = str(member.name)
 
-        if force or await self._show_sr_in_nick(member, user):
+        if force or await self._show_sr_in_nick(member, user, always_show_sr):
             if re.search(r"\[.*?\]", str(nn)):
                 new_nn = re.sub(r"\[.*?\]", f"[{formatted}]", nn)
             else:
@@ -2526,32 +2693,81 @@ Pornography Historian"""
 
         logger.debug("New nick for %s is %s", nn, new_nn)
 
-        if nn != new_nn:
+        # Discord might not have told us about the nick we set (or are setting) yet
+        current_nn = self._recent_nicks.get((member.guild_id, member.id), nn)
+        if current_nn == new_nn:
+            self._pending_nicks[member.guild_id].pop(member.id, None)
+        elif raise_hierachy_error:
+            # the caller wants to know whether it worked, so don't queue it
+            self._pending_nicks[member.guild_id].pop(member.id, None)
+            await self._set_nick(member, new_nn, reraise=True)
+        else:
+            await self._queue_nick(member, new_nn)
+
+        return new_nn
+
+    async def _set_nick(self, member, new_nn, *, reraise=False):
+        key = (member.guild_id, member.id)
+        # while it's being written, this is the nick later changes are compared to
+        self._recent_nicks[key] = new_nn
+        try:
+            await member.nickname.set(new_nn)
+        except (HierarchyError, PermissionsError):
+            self._recent_nicks.pop(key, None)
+            logger.info(
+                "Cannot update nick %s to %s due to insufficient permissions",
+                member.name,
+                new_nn,
+            )
+            if reraise:
+                raise
+        except Exception:
+            self._recent_nicks.pop(key, None)
+            logger.warn("error while setting nick", exc_info=True)
+            if reraise:
+                raise
+        else:
+            # the write might have waited for the rate limit for a while
+            self._recent_nicks[key] = new_nn
+
+    async def _queue_nick(self, member, new_nn):
+        """
+        Nickname changes share a rate limit per guild, so they are sent one after
+        another by a writer per guild. Only the latest change per member is sent.
+        """
+        pending = self._pending_nicks[member.guild_id]
+        pending[member.id] = (member, new_nn)
+
+        guild_id = member.guild_id
+        if guild_id in self._nick_writers:
+            return
+
+        async def write_nicks():
             try:
-                await member.nickname.set(new_nn)
-            except (HierarchyError, PermissionsError):
-                logger.info(
-                    "Cannot update nick %s to %s due to insufficient permissions",
-                    nn,
-                    new_nn,
-                )
-                if raise_hierachy_error:
-                    raise
+                while pending:
+                    member_id = next(iter(pending))
+                    member, new_nn = pending.pop(member_id)
+                    # curious waits if the guild's rate limit is exhausted
+                    await self._set_nick(member, new_nn)
             except Exception:
-                logger.warn("error while setting nick", exc_info=True)
-                raise
+                logger.exception("Unhandled exception in write_nicks")
+            finally:
+                self._nick_writers.discard(guild_id)
 
-        return new_nn
+        self._nick_writers.add(guild_id)
+        await self.spawn(write_nicks)
 
-    async def _show_sr_in_nick(self, member, user):
+    async def _show_sr_in_nick(self, member, user, always_show_sr=None):
         if self.guild_config[member.guild_id].show_sr_in_nicks_by_default:
             return True
 
-        if not user:
-            async with self.database.session() as session:
-                user = await self.database.user_by_discord_id(session, member.id)
+        if always_show_sr is None:
+            if not user:
+                async with self.database.session() as session:
+                    user = await self.database.user_by_discord_id(session, member.id)
+            always_show_sr = user.always_show_sr
 
-        if user.always_show_sr:
+        if always_show_sr:
             return True
 
         if member.voice:
@@ -2572,10 +2788,8 @@ Pornography Historian"""
     async def _send_congrats(self, handle, role_idx, sr, rank, image):
         user = handle.user
 
-        for guild in self._configured_guilds():
+        for guild in self._member_guilds(user.discord_id):
             try:
-                if user.discord_id not in guild.members:
-                    continue
                 CurrentLocale.set(self.guild_config[guild.id].locale)
                 embed = Embed(
                     # Translators: Used when somebody reached a new rank. Replace with the localized voiceline that Orisa uses
@@ -2607,236 +2821,267 @@ Pornography Historian"""
                 logger.exception(f"Cannot send congrats for guild {guild}")
 
     async def _top_players(self, guild_ids, style="fancy_grid", update_cron=True):
-        def prev_sr(tag):
-            for sr in tag.sr_history[:30]:
-                prev_sr = sr
-                if sr.timestamp < datetime.now() - timedelta(days=1):
-                    break
-            return prev_sr
+        guilds = [
+            guild for guild in self.client.guilds.values() if guild.id in guild_ids
+        ]
+        discord_ids = set()
+        for guild in guilds:
+            discord_ids.update(guild.members.keys())
 
         async with self.database.session() as session:
+            today = datetime.utcnow().date()
+            await self._ensure_leaderboard_snapshot(session, today)
+            entries = await self.database.get_leaderboard(session, today, discord_ids)
 
-            handles = {
-                (type_class, role): await run_sync(
-                    session.query(type_class)
-                    .options(joinedload(type_class.user))
-                    .join(type_class.current_sr)
-                    .order_by(desc(role))
-                    .filter(role != None)
-                    .filter(type_class.position == 0)
-                    .all
-                )
-                for role in [SR.tank, SR.damage, SR.support]
-                for type_class in [BattleTag, Gamertag, OnlineID]
+            prev_date = await self.database.get_previous_leaderboard_date(
+                session, today
+            )
+            prev_entries = (
+                await self.database.get_leaderboard(session, prev_date, discord_ids)
+                if prev_date
+                else []
+            )
+            prev_srs = {
+                (entry.type, entry.role, discord_id): entry.sr
+                for entry, discord_id in prev_entries
             }
 
-            def create_h_a_p():
+            leaderboards = {}
+            for entry, discord_id in entries:
+                leaderboards.setdefault((entry.type, entry.role), []).append(
+                    (
+                        discord_id,
+                        entry.sr,
+                        prev_srs.get((entry.type, entry.role, discord_id)),
+                    )
+                )
 
-                return [
-                    (c, t, handle, prev_sr(handle))
-                    for c in [BattleTag, Gamertag, OnlineID]
-                    for t in [SR.tank, SR.damage, SR.support]
-                    for handle in handles[c, t]
-                ]
+            top_per_guild = {}
 
-            handles_and_prev = await run_sync(create_h_a_p)
+            for type_class in [BattleTag, Gamertag, OnlineID]:
+                type = type_class.__mapper__.polymorphic_identity
+                for role in ["tank", "damage", "support"]:
+                    for discord_id, sr, prev_sr in leaderboards.get((type, role), []):
+                        for guild in guilds:
+                            try:
+                                member = guild.members[discord_id]
+                            except KeyError:
+                                continue
 
-            top_per_guild = {}
+                            top_per_guild.setdefault(guild.id, {}).setdefault(
+                                (type_class, role), []
+                            ).append((member, sr, prev_sr))
 
+        limiter = trio.CapacityLimiter(HIGHSCORE_POST_CONCURRENCY)
 
-            guilds = [
-                guild for guild in self.client.guilds.values() if guild.id in guild_ids
-            ]
+        async def post(guild_id, role_tops):
+            async with limiter:
+                try:
+                    await self._post_top_players(guild_id, role_tops, style)
+                except Exception:
+                    logger.exception(f"unable to post highscores to guild {guild_id}")
 
-            for type_class, type, handle, prev_sr in handles_and_prev:
-                for guild in guilds:
-                    try:
-                        member = guild.members[handle.user.discord_id]
-                    except KeyError:
-                        continue
+        # every guild has its own channel and thus its own rate limit bucket,
+        # curious waits when a bucket is exhausted, so there's no need to sleep
+        async with trio.open_nursery() as nursery:
+            for guild_id, role_tops in top_per_guild.items():
+                nursery.start_soon(post, guild_id, role_tops)
+
+    async def _post_top_players(self, guild_id, role_tops, style):
+        def member_name(member):
+            name = str(member.name)
+            name = re.sub(r"\[.*?\]", "", name)
+            name = re.sub(r"\{.*?\}", "", name)
+            name = re.sub(r"\s{2,}", " ", name)
+
+            return "".join(
+                ch if ord(ch) < 256 or unicodedata.category(ch)[0] != "S" else ""
+                for ch in name
+            )
 
-                    top_per_guild.setdefault(guild.id, {}).setdefault(
-                        (type_class, type.key), []
-                    ).append((member, handle, getattr(prev_sr, type.key)))
+        logger.debug(f"Processing guild {guild_id} for top_players")
+        CurrentLocale.set(self.guild_config[guild_id].locale)
+        for type_role, tops in role_tops.items():
+            type_class, role = type_role
 
-            def member_name(member):
-                name = str(member.name)
-                name = re.sub(r"\[.*?\]", "", name)
-                name = re.sub(r"\{.*?\}", "", name)
-                name = re.sub(r"\s{2,}", " ", name)
+            # FIXME: wrong if there is a tie
+            prev_top_members = [
+                top[0] for top in sorted(tops, key=lambda x: x[2] or 0, reverse=True)
+            ]
 
-                return "".join(
-                    ch if ord(ch) < 256 or unicodedata.category(ch)[0] != "S" else ""
-                    for ch in name
-                )
+            def prev_str(pos, member, prev_sr):
+                if not prev_sr:
+                    return "  (——)"
 
-            for guild_id, role_tops in top_per_guild.items():
-                logger.debug(f"Processing guild {guild_id} for top_players")
-                CurrentLocale.set(self.guild_config[guild_id].locale)
-                for type_role, tops in role_tops.items():
-                    type_class, role = type_role
-
-                    # FIXME: wrong if there is a tie
-                    prev_top_tags = [
-                        top[1]
-                        for top in sorted(tops, key=lambda x: x[2] or 0, reverse=True)
-                    ]
+                old_pos = prev_top_members.index(member) + 1
+                if pos == old_pos:
+                    sym = " "
+                elif pos > old_pos:
+                    sym = "↓"
+                else:
+                    sym = "↑"
 
-                    def prev_str(pos, tag, prev_sr):
-                        if not prev_sr:
-                            return "  (——)"
+                return f"{sym} ({old_pos:2})"
 
-                        old_pos = prev_top_tags.index(tag) + 1
-                        if pos == old_pos:
-                            sym = " "
-                        elif pos > old_pos:
-                            sym = "↓"
-                        else:
-                            sym = "↑"
+            def delta_fmt(curr, prev):
+                if not curr or not prev or curr == prev:
+                    return ""
+                else:
+                    return f"{curr-prev:+4}"
+
+            table_prev_sr = None
+            data = []
+            for ix, (member, sr, prev_sr) in enumerate(tops):
+                if sr != table_prev_sr:
+                    pos = ix + 1
+                table_prev_sr = sr
+                data.append(
+                    (
+                        pos,
+                        prev_str(ix + 1, member, prev_sr),
+                        member_name(member),
+                        member.id,
+                        sr,
+                        delta_fmt(sr, prev_sr),
+                    )
+                )
 
-                        return f"{sym} ({old_pos:2})"
+            intro, headers = _highscore_texts(
+                type_class, role, self.guild_config[guild_id].locale
+            )
+            csv_file = StringIO()
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(headers)
+            csv_writer.writerows(data)
 
-                    def delta_fmt(curr, prev):
-                        if not curr or not prev or curr == prev:
-                            return ""
-                        else:
-                            return f"{curr-prev:+4}"
-
-                    table_prev_sr = None
-                    data = []
-                    for ix, (member, handle, prev_sr) in enumerate(tops):
-                        if getattr(handle.sr, role) != table_prev_sr:
-                            pos = ix + 1
-                        sr = getattr(handle.sr, role)
-                        table_prev_sr = sr
-                        data.append(
-                            (
-                                pos,
-                                prev_str(ix + 1, handle, prev_sr),
-                                member_name(member),
-                                member.id,
-                                sr,
-                                delta_fmt(sr, prev_sr),
-                            )
-                        )
+            csv_file = BytesIO(csv_file.getvalue().encode("utf-8"))
+            csv_file.seek(0)
 
-                    headers = [
-                        # Translators: header for highscore table: position (keep it short)
-                        _("#"),
-                        # Translators: header for highscore table: previous position (keep it short)
-                        _("prev"),
-                        # Translators: header for highscore table: member name
-                        _("Member"),
-                        # Translators: header for highscore table: member discord id
-                        _("Member ID"),
-                        # Translators: header fdor highscore table: SR
-                        _("{role} SR").format(role=_(role.capitalize())),
-                        # Translators: header for highscore table: SR difference
-                        _("ΔSR"),
-                    ]
-                    csv_file = StringIO()
-                    csv_writer = csv.writer(csv_file)
-                    csv_writer.writerow(headers)
-                    csv_writer.writerows(data)
+            def no_id(x):
+                return x[:3] + x[4:]
 
-                    csv_file = BytesIO(csv_file.getvalue().encode("utf-8"))
-                    csv_file.seek(0)
+            tabulate.PRESERVE_WHITESPACE = True
+            table_lines = tabulate.tabulate(
+                (no_id(e) for e in data), headers=no_id(headers), tablefmt=style
+            ).split("\n")
 
-                    def no_id(x):
-                        return x[:3] + x[4:]
+            # fancy_grid inserts a ├─────┼───────┤ after every line, let's get rid of it
+            if style == "fancy_grid":
+                table_lines = [line for line in table_lines if not line.startswith("├")]
 
-                    tabulate.PRESERVE_WHITESPACE = True
-                    table_lines = tabulate.tabulate(
-                        (no_id(e) for e in data), headers=no_id(headers), tablefmt=style
-                    ).split("\n")
+            # Split table into submessages, because a short gap is visible after each message
+            # we want it to be in "nice" multiples
 
-                    # fancy_grid inserts a ├─────┼───────┤ after every line, let's get rid of it
-                    if style == "fancy_grid":
-                        table_lines = [
-                            line for line in table_lines if not line.startswith("├")
-                        ]
+            ix = 0
+            lines = 20
 
-                    # Split table into submessages, because a short gap is visible after each message
-                    # we want it to be in "nice" multiples
+            try:
+                logger.debug("trying to send highscore to %i…", guild_id)
+                chan = self.client.find_channel(
+                    self.guild_config[guild_id].listen_channel_id
+                )
+                if not chan:
+                    logger.debug("no channel found")
+                    return
+                logger.debug("found channel %s", chan)
+                send = chan.messages.send
+                # send = self.client.application_info.owner.send
+                await send(intro)
+                while ix < len(table_lines):
+                    # prefer splits at every "step" entry, but if it turns out too long, send a shorter message
+                    step = lines if ix else lines + 3
+                    await send_long(
+                        send,
+                        "```" + ("\n".join(table_lines[ix : ix + step]) + "```"),
+                    )
+                    ix += step
 
-                    ix = 0
-                    lines = 20
+                await chan.messages.upload(
+                    csv_file,
+                    filename=f"ranking_{role}_{type_class.blizzard_url_type.upper()}_{arrow.now().isoformat()[:10]}.csv",
+                )
+                logger.debug("upload done")
+            except Exception:
+                logger.exception("unable to send top players to guild %i", guild_id)
 
-                    try:
-                        logger.debug("trying to send highscore to %i…", guild_id)
-                        chan = self.client.find_channel(
-                            self.guild_config[guild_id].listen_channel_id
-                        )
-                        if not chan:
-                            logger.debug("no channel found")
-                            continue
-                        logger.debug("found channel %s", chan)
-                        send = chan.messages.send
-                        # send = self.client.application_info.owner.send
-                        await send(
-                            _(
-                                "Hello! Here are the current SRs for **{role}** on {platform}. If a member has more than one "
-                                "{handle_type}, only the primary {handle_type} is considered. Players with "
-                                "private profiles, or those that didn't do their placements this season yet "
-                                "are not shown."
-                            ).format(
-                                role=_(role.capitalize()),
-                                platform=type_class.blizzard_url_type.upper(),
-                                handle_type=_(type_class.desc),
-                            )
-                        )
-                        while ix < len(table_lines):
-                            # prefer splits at every "step" entry, but if it turns out too long, send a shorter message
-                            step = lines if ix else lines + 3
-                            await send_long(
-                                send,
-                                "```"
-                                + ("\n".join(table_lines[ix : ix + step]) + "```"),
-                            )
-                            ix += step
+    async def _ensure_leaderboard_snapshot(self, session, date):
+        async with self._leaderboard_snapshot_lock:
+            if not await self.database.has_leaderboard_snapshot(session, date):
+                logger.info(f"taking leaderboard snapshot for {date}")
+                await self.database.take_leaderboard_snapshot(session, date)
+                await run_sync(session.commit)
 
-                        await chan.messages.upload(
-                            csv_file,
-                            filename=f"ranking_{role}_{type_class.blizzard_url_type.upper()}_{arrow.now().isoformat()[:10]}.csv",
-                        )
-                        logger.debug("upload done")
-                    except Exception:
-                        logger.exception(
-                            "unable to send top players to guild %i", guild_id
-                        )
+    async def _leaderboard_snapshot_task(self):
+        while True:
+            try:
+                async with self.database.session() as session:
+                    await self._ensure_leaderboard_snapshot(
+                        session, datetime.utcnow().date()
+                    )
+            except Exception:
+                logger.exception("Error while taking leaderboard snapshot")
 
-                    # wait a bit before sending the next batch to avoid running into
-                    # rate limiting and sending data twice due to "timeouts"
-                    logger.debug("sleeping for 5s")
-                    await trio.sleep(5)
-                    logger.debug("done sleeping")
-                # one guild done
+            now = datetime.utcnow()
+            midnight = datetime.combine(
+                now.date() + timedelta(days=1), datetime.min.time()
+            )
+            await trio.sleep((midnight - now).total_seconds() + 1)
 
     async def _message_new_guilds(self):
         for guild_id, guild in self.client.guilds.copy().items():
             if guild_id not in self.guild_config:
                 await self._handle_new_guild(guild)
 
-    async def _sync_handle(self, session, handle):
+    async def _fetch_sr(self, handle, *, conditional=True):
+        """Requests the SR of the handle.
+
+        Returns (srs, images), None if the profile didn't change, or the
+        exception that occurred."""
         try:
-            srs, images = await get_sr(handle)
+            return await get_sr(handle, conditional=conditional)
+        except ProfileUnchanged:
+            logger.debug(f"Profile of {handle} is unchanged")
+            return None
         except UnableToFindSR:
             logger.debug(f"No SR for {handle}, oh well…")
-            srs = TDS(None, None, None)
-            images = [None] * 3
-        except Exception:
-            handle.error_count += 1
-            # we need to update the last_update pseudo-column
-            handle.update_sr(handle.sr)
+            return TDS(None, None, None), [None] * 3
+        except Exception as e:
             if self.raven_client:
                 self.raven_client.captureException()
             logger.exception(f"Got exception while requesting {handle.handle}")
-            raise
+            return e
+
+    def _apply_sr(self, handle, result, recent=None):
+        """Stores the result of _fetch_sr in the handle.
+
+        The caller has to _push_sync the handle after committing.
+
+        Returns the previous peak SRs if there is a new SR, None otherwise."""
+        if isinstance(result, Exception):
+            handle.error_count += 1
+            # we need to update the last_update pseudo-column
+            handle.update_sr(handle.sr, recent=recent)
+            self.database.schedule_sync(handle)
+            return None
+
         handle.error_count = 0
-        handle.update_sr(srs)
-        await self._handle_new_sr(session, handle, srs, images)
+        handle.last_checked_at = datetime.utcnow()
+        previous_peaks = None
+        if result is not None:
+            previous_peaks = handle.update_sr(result[0], recent=recent)
+        self.database.schedule_sync(handle)
+        return previous_peaks
 
-    async def _handle_new_sr(self, session, handle, srs, images):
+    async def _sync_handle(self, session, handle):
+        # used by forceupdate, which must not rely on what we stored
+        result = await self._fetch_sr(handle, conditional=False)
+        previous_peaks = self._apply_sr(handle, result)
+        if previous_peaks is not None:
+            await self._handle_new_sr(session, handle, *result, previous_peaks)
+        elif isinstance(result, Exception):
+            raise result
+
+    async def _handle_new_sr(self, session, handle, srs, images, previous_peaks):
         try:
             await self._update_nick(handle.user)
         except HierarchyError:
@@ -2867,149 +3112,274 @@ Pornography Historian"""
 
             # we can still do the rest, no need to return here
 
-        for role_ix, rank, sr, type_to_check, image in zip(
-            range(3), handle.rank, srs, [SR.tank, SR.damage, SR.support], images
+        for role_ix, rank, sr, peak_sr, image in zip(
+            range(3), handle.rank, srs, previous_peaks, images
         ):
+            logger.debug(f"prev_sr {role_ix} {peak_sr} {rank}")
+            if rank is not None and peak_sr is not None and rank > sr_to_rank(peak_sr):
+                logger.debug(
+                    f"handle {handle} role {role_ix} old SR {peak_sr}, new rank {rank}, sending congrats…"
+                )
+                await self._send_congrats(handle, role_ix, sr, rank, image)
 
-            if rank is not None:
-                # get highest SR, but exclude current_sr
-                await run_sync(session.commit)
-                prev_highest_sr_value = (
-                    session.query(func.max(type_to_check))
-                    .join(SR.handle)
-                    .filter(
-                        SR.id != handle.current_sr_id,
-                        Handle.user_id == handle.user_id,
-                        Handle.type == handle.type,
+    async def _sync_handles(self, ids_to_sync):
+        ids_to_sync = [id for id in ids_to_sync if id not in self.sync_cache]
+        if not ids_to_sync:
+            logger.debug("Already updated, not doing it again")
+            return
+        for handle_id in ids_to_sync:
+            self.sync_cache[handle_id] = True  # any value really
+
+        async with self.database.session() as session:
+            # the handles are still needed after the commits
+            session.expire_on_commit = False
+            try:
+                handles = await self.database.handles_by_ids(session, ids_to_sync)
+                if len(handles) < len(ids_to_sync):
+                    logger.warn(
+                        f"{len(ids_to_sync) - len(handles)} handles not found, probably deleted"
                     )
+                recent_srs = await self.database.get_recent_srs(
+                    session, [handle.id for handle in handles]
                 )
+                # fetching can take minutes, don't stay idle in a transaction meanwhile
+                await run_sync(session.commit)
 
-                prev_highest_sr = (
-                    session.query(SR)
-                    .join(SR.handle)
-                    .filter(
-                        type_to_check == prev_highest_sr_value,
-                        Handle.user_id == handle.user_id,
-                        Handle.type == handle.type,
+                # rate limiting is done by get_sr
+                results = {}
+
+                async def fetch(handle):
+                    results[handle.id] = await self._fetch_sr(handle)
+
+                async with trio.open_nursery() as nursery:
+                    for handle in handles:
+                        nursery.start_soon(fetch, handle)
+
+                changed = []
+                for handle in handles:
+                    previous_peaks = self._apply_sr(
+                        handle, results[handle.id], recent_srs.get(handle.id, [])
                     )
-                    .order_by(desc(SR.timestamp))
-                    .first()
-                )
+                    if previous_peaks is not None:
+                        changed.append((handle, previous_peaks))
+                await run_sync(session.commit)
+                for handle in handles:
+                    self._push_sync(handle.id, handle.next_sync_at)
+            except Exception:
+                logger.exception(f"exception while syncing {len(ids_to_sync)} handles")
+                # make sure they are not dropped from the sync schedule
+                retry_at = datetime.utcnow() + timedelta(minutes=5)
+                for handle_id in ids_to_sync:
+                    if handle_id not in self._sync_due:
+                        self._push_sync(handle_id, retry_at)
+                return
 
-                logger.debug(f"prev_sr {role_ix} {prev_highest_sr} {rank}")
-                if prev_highest_sr and rank > sr_to_rank(
-                    prev_highest_sr.values[role_ix]
-                ):
-                    logger.debug(
-                        f"handle {handle} role {role_ix} old SR {prev_highest_sr}, new rank {rank}, sending congrats…"
+            for handle, previous_peaks in changed:
+                # the new SRs are committed, so the cached nick can go
+                self._forget_nick(handle.user.discord_id)
+                try:
+                    await self._handle_new_sr(
+                        session, handle, *results[handle.id], previous_peaks
+                    )
+                except Exception:
+                    logger.warn(
+                        f"exception while handling new SR of {handle} for {handle.user.discord_id}",
+                        exc_info=True,
                     )
-                    await self._send_congrats(handle, role_ix, sr, rank, image)
+            try:
+                await run_sync(session.commit)
+            except Exception:
+                logger.exception("cannot sync session")
+
+        logger.info(
+            f"done syncing {len(ids_to_sync)} handles, SR requests: {SR_REQUESTS}"
+        )
 
     async def _sync_handles_from_channel(self, channel):
-        first = True
         async with channel:
-            async for handle_id in channel:
-                if handle_id in self.sync_cache:
-                    logger.debug("Already updated, not doing it again")
+            async for ids_to_sync in channel:
+                await self._sync_handles(ids_to_sync)
+
+    def _push_sync(self, handle_id, next_sync_at):
+        self._sync_due[handle_id] = next_sync_at
+        heapq.heappush(self._sync_queue, (next_sync_at, handle_id))
+        if self._sync_queue[0] == (next_sync_at, handle_id):
+            # the scheduler might be sleeping for longer than necessary
+            self._sync_queue_changed.set()
+
+    async def _dispatch_due_handles(self, send_ch):
+        while True:
+            self._sync_queue_changed = trio.Event()
+
+            now = datetime.utcnow()
+            batch = []
+            while self._sync_queue and self._sync_queue[0][0] <= now:
+                next_sync_at, handle_id = heapq.heappop(self._sync_queue)
+                if self._sync_due.get(handle_id) != next_sync_at:
+                    # rescheduled in the meantime
                     continue
-                else:
-                    self.sync_cache[handle_id] = True  # any value really
-                if not first:
-                    delay = 1 + random.random() * 5
-                    logger.debug(f"rate limiting: sleeping for {delay:3.02}s")
-                    await trio.sleep(delay)
-                else:
-                    first = False
-                async with self.database.session() as session:
-                    try:
-                        handle = await self.database.handle_by_id(session, handle_id)
-                        if handle:
-                            await self._sync_handle(session, handle)
-                        else:
-                            logger.warn(
-                                f"No handle for id {handle_id} found, probably deleted"
-                            )
-                        await run_sync(session.commit)
-                    except Exception:
-                        if handle:
-                            logger.warn(
-                                f"exception while syncing {handle} for {handle.user.discord_id}",
-                                exc_info=True,
-                            )
-                        else:
-                            logger.warn(
-                                "Exception while getting handle for sync", exc_info=True
-                            )
-                    finally:
-                        try:
-                            await run_sync(session.commit)
-                        except Exception:
-                            logger.exception("cannot sync session")
+                del self._sync_due[handle_id]
+                batch.append(handle_id)
+                if len(batch) == SYNC_BATCH_SIZE:
+                    await send_ch.send(batch)
+                    batch = []
+                    now = datetime.utcnow()
+            if batch:
+                await send_ch.send(batch)
+                continue
 
-    async def _sync_check(self):
-        async with self.database.session() as session:
-            ids_to_sync = await self.database.get_handles_to_be_synced(session)
-        if ids_to_sync:
-            logger.info(f"{len(ids_to_sync)} handles need to be synced")
-            await self._sync_handles(ids_to_sync)
-        else:
-            logger.debug("No tags need to be synced")
+            if self._sync_queue:
+                timeout = (self._sync_queue[0][0] - now).total_seconds()
+            else:
+                timeout = math.inf
 
-    async def _sync_handles(self, ids_to_sync):
-        send_ch, receive_ch = trio.open_memory_channel(len(ids_to_sync))
+            with trio.move_on_after(timeout):
+                await self._sync_queue_changed.wait()
 
-        async with send_ch:
-            for tag_id in ids_to_sync:
-                await send_ch.send(tag_id)
+    async def _sync_all_handles_task(self):
+        logger.debug("started waiting…")
+        await trio.sleep(10)
+
+        async with self.database.session() as session:
+            schedule = await self.database.get_sync_schedule(session)
+        for next_sync_at, handle_id in schedule:
+            # don't overwrite handles that have been synced in the meantime
+            self._sync_due.setdefault(handle_id, next_sync_at)
+        self._sync_queue.extend(schedule)
+        heapq.heapify(self._sync_queue)
+        logger.info(f"scheduled {len(schedule)} handles for syncing")
+
+        send_ch, receive_ch = trio.open_memory_channel(0)
 
         async with trio.open_nursery() as nursery:
             async with receive_ch:
-                for _ in range(min(len(ids_to_sync), 5)):
+                # the actual request rate is controlled by get_sr, more than one
+                # worker is needed so that a batch can be fetched while the
+                # previous one is being written to the database
+                for _ in range(SYNC_BATCH_WORKERS):
                     nursery.start_soon(
                         self._sync_handles_from_channel, receive_ch.clone()
                     )
-        logger.info("done syncing")
+            async with send_ch:
+                await self._dispatch_due_handles(send_ch)
 
-    async def _sync_all_handles_task(self):
-        logger.debug("started waiting…")
-        await trio.sleep(10)
-        while True:
-            try:
-                await self._sync_check()
-            except Exception as e:
-                logger.exception(f"something went wrong during _sync_check")
-            await trio.sleep(60)
+    def _schedule_highscores(self, guild_id, next_run):
+        "Schedules the next highscore post of the guild, None to unschedule it"
+        if next_run is None:
+            self._cron_due.pop(guild_id, None)
+            return
+        self._cron_due[guild_id] = next_run
+        heapq.heappush(self._cron_queue, (next_run, guild_id))
+        if self._cron_queue[0] == (next_run, guild_id):
+            self._cron_queue_changed.set()
+
+    async def _run_due_highscores(self):
+        "Updates next_run of all due guilds and returns their IDs"
+        now = datetime.utcnow()
+        guild_ids = []
+        while self._cron_queue and self._cron_queue[0][0] <= now:
+            next_run, guild_id = heapq.heappop(self._cron_queue)
+            if self._cron_due.get(guild_id) != next_run:
+                # rescheduled or unscheduled in the meantime
+                continue
+            del self._cron_due[guild_id]
+            guild_ids.append(guild_id)
+
+        if not guild_ids:
+            return []
+
+        async with self.database.session() as s:
+            to_run = await run_sync(
+                s.query(HighscoreCron).filter(HighscoreCron.id.in_(guild_ids)).all
+            )
+            for hc in to_run:
+                hc.last_run = now
+                n = hc.next_run
+                n = now.replace(
+                    hour=n.hour, minute=n.minute, second=n.second, microsecond=0
+                ) + timedelta(days=1)
+                hc.next_run = n
+            await run_sync(s.commit)
+
+            for hc in to_run:
+                self._schedule_highscores(hc.id, hc.next_run)
+
+        return [hc.id for hc in to_run]
 
     async def _cron_task(self):
         "poor man's cron"
 
+        async with self.database.session() as s:
+            crons = await run_sync(
+                s.query(HighscoreCron.id, HighscoreCron.next_run)
+                .filter(HighscoreCron.next_run.isnot(None))
+                .all
+            )
+        now = datetime.utcnow()
+        missed = 0
+        for guild_id, next_run in crons:
+            self._schedule_highscores(guild_id, next_run)
+            if next_run <= now:
+                missed += 1
+        logger.info(
+            f"scheduled highscores for {len(crons)} guilds, {missed} runs were missed"
+        )
+
+        async with trio.open_nursery() as nursery:
+            while True:
+                self._cron_queue_changed = trio.Event()
+                try:
+                    guild_ids = await self._run_due_highscores()
+                    if guild_ids:
+                        logger.debug("running highscores for %s", guild_ids)
+                        # missed runs end up here all at once after a restart
+                        nursery.start_soon(self._run_top_players, guild_ids)
+                        continue
+                except Exception:
+                    logger.exception("Error during cron")
+
+                if self._cron_queue:
+                    timeout = (
+                        self._cron_queue[0][0] - datetime.utcnow()
+                    ).total_seconds()
+                else:
+                    timeout = math.inf
+
+                with trio.move_on_after(timeout):
+                    await self._cron_queue_changed.wait()
+
+    async def _run_top_players(self, guild_ids):
+        try:
+            await self._top_players(guild_ids)
+            logger.debug("done running highscores")
+        except Exception:
+            logger.exception("Error while running highscores")
+
+    async def _compact_sr_history_task(self):
+        # don't compete with the initial sync
+        await trio.sleep(30 * 60)
+
         while True:
             try:
-                logger.debug("checking Cron…")
-                async with self.database.session() as s:
-                    now = datetime.utcnow()
-                    to_run = await run_sync(
-                        s.query(HighscoreCron).filter(HighscoreCron.next_run <= now).all
-                    )
-                    logger.debug("to_run %s", to_run)
-                    for hc in to_run:
-                        hc.last_run = now
-                        n = hc.next_run
-                        n = now.replace(
-                            hour=n.hour, minute=n.minute, second=n.second, microsecond=0
-                        ) + timedelta(days=1)
-                        hc.next_run = n
-                    await run_sync(s.commit)
-
-                    guild_ids = [h.id for h in to_run]
-
-                if guild_ids:
-                    logger.debug("running highscores…")
-                    await self._top_players(guild_ids)
-                    logger.debug("done running highscores")
+                logger.info("compacting SR history…")
+                async with self.database.session() as session:
+                    handle_ids = await self.database.get_handle_ids(session)
+
+                deleted = 0
+                for start in range(0, len(handle_ids), SR_COMPACTION_BATCH_SIZE):
+                    async with self.database.session() as session:
+                        deleted += await self.database.compact_sr_history(
+                            session,
+                            handle_ids[start : start + SR_COMPACTION_BATCH_SIZE],
+                        )
+                        await run_sync(session.commit)
+                    # give the other tasks a chance to use the database
+                    await trio.sleep(1)
+
+                logger.info(f"done compacting SR history, deleted {deleted} SRs")
             except Exception:
-                logger.exception("Error during cron")
-            await trio.sleep(1 * 60)
+                logger.exception("Error during SR history compaction")
+            await trio.sleep(24 * 60 * 60)
 
     async def _web_server(self):
         config = hypercorn.config.Config()
@@ -3089,12 +3459,9 @@ Pornography Historian"""
                 handles_to_check = handles
 
                 extra_text = ""
-                for guild in self._configured_guilds():
-                    if user_id in guild.members:
-                        extra_text = (
-                            self.guild_config[guild.id].extra_register_text or ""
-                        )
-                        break
+                for guild in self._member_guilds(user_id):
+                    extra_text = self.guild_config[guild.id].extra_register_text or ""
+                    break
                 first, *others = handles
                 if others:
                     # Translators: type will be BattleTag or GamerTag, and it must be transformed into plural
@@ -3247,10 +3614,16 @@ Pornography Historian"""
                         logger.exception("Unable to delete check message")
 
                 handle.update_sr(srs)
+                handle.last_checked_at = datetime.utcnow()
+                self.database.schedule_sync(handle)
 
             sort_secondaries(user)
 
             await run_sync(session.commit)
+            self._forget_nick(user.discord_id)
+
+            for handle in handles_to_check:
+                self._push_sync(handle.id, handle.next_sync_at)
 
             try:
                 await self._update_nick(user, force=True, raise_hierachy_error=True)
@@ -3314,6 +3687,29 @@ Pornography Historian"""
             if guild.id in self.guild_config
         ]
 
+    def _member_guilds(self, user_id, *, configured=True):
+        "Returns the (configured) guilds the user is a member of"
+        guilds = []
+        for guild_id in self._guild_ids_by_member.get(user_id, ()):
+            guild = self.client.guilds.get(guild_id)
+            if (
+                guild
+                and user_id in guild.members
+                and (not configured or guild_id in self.guild_config)
+            ):
+                guilds.append(guild)
+        return guilds
+
+    def _index_guild_members(self, guild):
+        for member_id in guild.members.keys():
+            self._guild_ids_by_member[member_id].add(guild.id)
+
+    def _unindex_guild_members(self, guild):
+        for member_id in guild.members.keys():
+            guild_ids = self._guild_ids_by_member.get(member_id)
+            if guild_ids:
+                guild_ids.discard(guild.id)
+
 
 def fuzzy_nick_match(ann, ctx: Context, name: str):
     def strip_tags(name):
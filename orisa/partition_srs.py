@@ -0,0 +1,132 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Partitions the srs table by year (PostgreSQL 12 or newer only).
+
+This is optional, and only worth it for very large SR histories. Stop Orisa and
+run `python -m orisa.partition_srs --database-uri URI` once to convert the
+table; running it again later only adds the partitions for the coming years,
+so it should be run at least once a year. Rows that fall outside of all
+partitions end up in srs_default.
+
+Because the primary key of a partitioned table must contain the partition key,
+it becomes (id, timestamp), and the foreign key from handle.current_sr_id to
+srs.id has to be dropped. SQLAlchemy does not need it.
+
+To go back, create an unpartitioned table with `INSERT INTO ... SELECT` and
+swap the tables.
+"""
+import argparse
+import logging
+
+from datetime import datetime
+
+from sqlalchemy import create_engine
+
+logger = logging.getLogger(__name__)
+
+# how many years of partitions are created in advance
+YEARS_AHEAD = 2
+
+_CREATE_PARTITIONED = """
+CREATE TABLE srs (
+    id integer NOT NULL DEFAULT nextval('srs_id_seq'),
+    handle_id integer NOT NULL REFERENCES handle (id),
+    timestamp timestamp without time zone NOT NULL,
+    tank smallint,
+    damage smallint,
+    support smallint,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp)
+"""
+
+# the same indexes as in models.SR, they are created on every partition
+_CREATE_INDEXES = [
+    "CREATE INDEX ix_srs_id ON srs (id)",
+    "CREATE INDEX ix_srs_handle_id_timestamp "
+    "ON srs (handle_id, timestamp DESC, id, tank, damage, support)",
+]
+
+
+def _is_partitioned(conn):
+    return conn.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = 'srs'::regclass)"
+    ).scalar()
+
+
+def _create_partitions(conn, first_year, last_year):
+    for year in range(first_year, last_year + 1):
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS srs_{year} PARTITION OF srs "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        )
+
+
+def partition(conn):
+    first_year = (
+        conn.execute(
+            "SELECT extract(year FROM min(timestamp))::integer FROM srs"
+        ).scalar()
+        or datetime.utcnow().year
+    )
+    last_year = datetime.utcnow().year + YEARS_AHEAD
+
+    logger.info("converting srs to a partitioned table…")
+    conn.execute(
+        "ALTER TABLE handle DROP CONSTRAINT IF EXISTS handle_current_sr_id_fkey"
+    )
+    conn.execute("ALTER TABLE srs RENAME TO srs_unpartitioned")
+    # index names must be unique
+    conn.execute("ALTER INDEX srs_pkey RENAME TO srs_unpartitioned_pkey")
+    conn.execute(_CREATE_PARTITIONED)
+    _create_partitions(conn, first_year, last_year)
+    conn.execute("CREATE TABLE srs_default PARTITION OF srs DEFAULT")
+
+    logger.info("copying SRs…")
+    conn.execute(
+        "INSERT INTO srs SELECT id, handle_id, timestamp, tank, damage, support FROM srs_unpartitioned"
+    )
+    conn.execute("ALTER SEQUENCE srs_id_seq OWNED BY srs.id")
+    conn.execute("DROP TABLE srs_unpartitioned")
+
+    logger.info("creating indexes…")
+    for statement in _CREATE_INDEXES:
+        conn.execute(statement)
+    conn.execute("ANALYZE srs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--database-uri", required=True)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine(options.database_uri)
+    if engine.dialect.name != "postgresql":
+        raise SystemExit("Partitioning is only supported for PostgreSQL")
+
+    with engine.begin() as conn:
+        if _is_partitioned(conn):
+            this_year = datetime.utcnow().year
+            logger.info("srs is already partitioned, adding missing partitions")
+            _create_partitions(conn, this_year, this_year + YEARS_AHEAD)
+        else:
+            partition(conn)
+    logger.info("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,14 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import functools
+import hashlib
 import logging
 import re
 
 from bisect import bisect
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from operator import attrgetter
 
 import asks
@@ -29,11 +32,12 @@ from lxml import html
 from .exceptions import (
     BlizzardError,
     InvalidBattleTag,
+    ProfileUnchanged,
     UnableToFindSR,
     NicknameTooLong,
     InvalidFormat,
 )
-from .config import DATABASE_URI
+from .config import BLIZZARD_BASE_URL, DATABASE_URI, SR_PARSE_PROCESSES
 
 logger = logging.getLogger(__name__)
 
@@ -61,10 +65,66 @@ class TDS(namedtuple("TDS", "tank damage support")):
         return f"{self.tank}-{self.damage}-{self.support}"
 
 
-SR_CACHE = TTLCache(maxsize=1000, ttl=30)
-SR_LOCKS = TTLCache(
-    maxsize=1000, ttl=60
-)  # if a request should be hanging for 60s, just try another
+class AdaptiveRateLimiter:
+    """Token bucket for requests to Blizzard whose rate adapts to the responses.
+
+    The rate is increased additively as long as requests are answered quickly
+    and successfully, and cut multiplicatively when Blizzard signals overload
+    (429, 5xx or timeouts)."""
+
+    def __init__(
+        self,
+        rate=1.0,
+        *,
+        min_rate=0.2,
+        max_rate=10.0,
+        burst=3,
+        increase=0.05,
+        decrease=0.5,
+        slow_response=5.0,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_response = slow_response
+
+        self._tokens = burst
+        self._last_refill = None
+        self._lock = trio.Lock()
+
+    def _refill(self):
+        now = trio.current_time()
+        if self._last_refill is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last_refill) * self.rate
+            )
+        self._last_refill = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await trio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            # might become slightly negative if the rate was lowered while
+            # we were sleeping, the next caller will have to wait longer then
+            self._tokens -= 1
+
+    def success(self, duration):
+        if duration < self.slow_response and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            logger.debug("increasing Blizzard request rate to %.2f/s", self.rate)
+
+    def backoff(self):
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        logger.info("Blizzard seems overloaded, request rate is now %.2f/s", self.rate)
+
+
+# shared by all SR requests (background sync, forceupdate, registration)
+SR_RATE_LIMITER = AdaptiveRateLimiter()
 
 
 _SESSION = asks.Session(
@@ -73,81 +133,321 @@ _SESSION = asks.Session(
 )
 
 
-async def get_sr(handle):
-    try:
-        lock = SR_LOCKS[handle.handle]
-    except KeyError:
-        lock = trio.Lock()
-        SR_LOCKS[handle.handle] = lock
+_COMPETITIVE_RANK_START_RE = re.compile(rb'<div[^>]*\sclass="competitive-rank"[^>]*>')
+_DIV_TAG_RE = re.compile(rb"<(/?)div\b[^>]*>")
 
-    await lock.acquire()
-    try:
+
+class _CompetitiveRankScanner:
+    """Finds the first competitive-rank div in a career page while it is being received.
+
+    Only complete tags are matched, so chunks may be split anywhere."""
+
+    def __init__(self):
+        self.content = bytearray()
+        self.fragment = None
+        self._start = None
+        self._pos = 0
+        self._depth = 0
+
+    def feed(self, chunk):
+        "Returns True once the competitive-rank div is complete"
+        self.content += chunk
+
+        if self._start is None:
+            match = _COMPETITIVE_RANK_START_RE.search(self.content, self._pos)
+            if not match:
+                # the start tag might be split between two chunks
+                self._pos = max(0, len(self.content) - 500)
+                return False
+            self._start = self._pos = match.start()
+
+        for match in _DIV_TAG_RE.finditer(self.content, self._pos):
+            self._pos = match.end()
+            if match.group(1):
+                self._depth -= 1
+                if self._depth == 0:
+                    self.fragment = bytes(self.content[self._start : self._pos])
+                    return True
+            else:
+                self._depth += 1
+
+        return False
+
+
+def parse_competitive_rank(fragment):
+    """Extracts SRs and rank images from the competitive-rank div.
+
+    Returns None if the div doesn't contain any SR."""
+
+    combined = {}
+    for role_div in html.fragment_fromstring(fragment).iterchildren("div"):
+        if role_div.get("class") != "competitive-rank-role":
+            continue
+
+        desc = sr = image = None
+        for elem in role_div.iterdescendants("div", "img"):
+            cls = elem.get("class", "")
+            if elem.tag == "img":
+                if image is None and cls == "competitive-rank-tier-icon":
+                    image = elem.get("src")
+            elif desc is None and "competitive-rank-tier-tooltip" in cls:
+                desc = elem.get("data-ow-tooltip-text")
+            elif sr is None and cls == "competitive-rank-level":
+                sr = elem.text
+
+        if desc and sr:
+            combined[desc.split()[0]] = (sr, image)
+
+    if not combined:
+        return None
+
+    sr_list = [
+        int(combined[n][0]) if n in combined else None
+        for n in "Tank Damage Support".split()
+    ]
+    img_list = [
+        combined[n][1] if n in combined else None for n in "Tank Damage Support".split()
+    ]
+
+    return TDS(*sr_list), TDS(*img_list)
+
+
+_PARSE_EXECUTOR = None
+
+
+async def _parse_competitive_rank_offloaded(fragment):
+    "Runs parse_competitive_rank outside of the event loop thread"
+    global _PARSE_EXECUTOR
+
+    if not SR_PARSE_PROCESSES:
+        return await trio.to_thread.run_sync(parse_competitive_rank, fragment)
+
+    if _PARSE_EXECUTOR is None:
+        _PARSE_EXECUTOR = ProcessPoolExecutor(max_workers=SR_PARSE_PROCESSES)
+    future = _PARSE_EXECUTOR.submit(parse_competitive_rank, fragment)
+    return await trio.to_thread.run_sync(future.result)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = trio.Event()
+        self.result = self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single call and caches the results.
+
+    The cache is bounded by the (estimated) size of its results, as given by getsizeof,
+    instead of their number."""
+
+    def __init__(self, *, ttl, max_size, getsizeof):
+        self._in_flight = {}
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl, getsizeof=getsizeof)
+        self.hits = self.misses = self.coalesced = 0
+
+    async def get(self, key, fetch, *, cacheable=lambda result: True):
         try:
-            res = SR_CACHE[handle.handle]
-            logger.info(f"got SR for {handle} from cache")
-            return res
+            result = self._cache[key]
         except KeyError:
             pass
+        else:
+            self.hits += 1
+            return result
+
+        flight = self._in_flight.get(key)
+        if flight:
+            self.coalesced += 1
+            await flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        self.misses += 1
+        flight = self._in_flight[key] = _Flight()
+        try:
+            flight.result = await fetch()
+        except trio.Cancelled:
+            # don't cancel the waiting tasks, they have nothing to do with it
+            flight.error = BlizzardError("Request was cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            if cacheable(flight.result):
+                try:
+                    self._cache[key] = flight.result
+                except ValueError:
+                    # too large to be cached at all
+                    pass
+            return flight.result
+        finally:
+            del self._in_flight[key]
+            flight.done.set()
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses, {self.coalesced} coalesced"
+
 
-        url = f'https://playoverwatch.com/en-us/career/{handle.blizzard_url_type}/{handle.handle.replace("#", "-")}'
+class CareerProfile:
+    "The SR relevant part of a career page request"
 
+    def __init__(self, validators, *, not_modified=False, headers=None, fragment=None):
+        # the (ETag, Last-Modified) sent with the request
+        self.validators = validators
+        self.not_modified = not_modified
+        headers = headers or {}
+        self.etag = headers.get("etag")
+        self.last_modified = headers.get("last-modified")
+        self.fragment = fragment
+        self.fragment_hash = fragment and hashlib.sha1(fragment).hexdigest()
+        self._parsed = None
+
+    async def parsed(self):
+        if self._parsed is None:
+            self._parsed = await _parse_competitive_rank_offloaded(self.fragment)
+        return self._parsed
+
+    def size(self):
+        return len(self.fragment or b"") + 500
+
+
+SR_REQUESTS = SingleFlight(ttl=30, max_size=10_000_000, getsizeof=CareerProfile.size)
+
+
+class SRSource:
+    "Where get_sr gets the career profiles from"
+
+    async def fetch_profile(self, handle, validators):
+        """Returns the CareerProfile of the handle.
+
+        validators is the (ETag, Last-Modified) tuple for a conditional request,
+        the elements may be None."""
+        raise NotImplementedError
+
+
+class HTTPSRSource(SRSource):
+    "Scrapes the career pages of playoverwatch.com, or of a server imitating it"
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def url(self, handle):
+        return f'{self.base_url}/en-us/career/{handle.blizzard_url_type}/{handle.handle.replace("#", "-")}'
+
+    async def fetch_profile(self, handle, validators):
+        url = self.url(handle)
+
+        etag, last_modified = validators
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        await SR_RATE_LIMITER.acquire()
         logger.debug("requesting %s", url)
+        start = trio.current_time()
+        scanner = _CompetitiveRankScanner()
         try:
-            result = await _SESSION.get(url, connection_timeout=60, timeout=60)
-        except asks.errors.RequestTimeout:
+            with trio.fail_after(60):
+                result = await _SESSION.get(
+                    url, headers=headers, stream=True, connection_timeout=60, timeout=60
+                )
+                async with result.body:
+                    if result.status_code == 200:
+                        # the SR is near the top of the page, no need to
+                        # download the rest
+                        async for chunk in result.body:
+                            if scanner.feed(chunk):
+                                break
+        except (asks.errors.RequestTimeout, trio.TooSlowError):
+            SR_RATE_LIMITER.backoff()
             raise BlizzardError("Timeout")
         except Exception as e:
             raise BlizzardError("Something went wrong", e)
+        if result.status_code == 429 or result.status_code >= 500:
+            SR_RATE_LIMITER.backoff()
+        elif result.status_code in (200, 304):
+            SR_RATE_LIMITER.success(trio.current_time() - start)
+        if result.status_code == 304:
+            return CareerProfile(validators, not_modified=True)
         if result.status_code != 200:
             raise BlizzardError(f"got status code {result.status_code} from Blizz")
 
-        document = html.fromstring(result.content)
-
-        role_divs = document.xpath(
-            '(//div[@class="competitive-rank"])[1]/div[@class="competitive-rank-role"]'
-        )
-
-        rank_images = [
-            r.xpath('descendant::img[@class="competitive-rank-tier-icon"]/@src')
-            for r in role_divs
-        ]
-        role_descs = [
-            r.xpath(
-                'descendant::div[contains(@class, "competitive-rank-tier-tooltip")]/@data-ow-tooltip-text'
-            )
-            for r in role_divs
-        ]
-        srs = [
-            r.xpath('descendant::div[@class="competitive-rank-level"]/text()')
-            for r in role_divs
-        ]
-
-        if not any(srs):
-            if "Profile Not Found" in result.text:
+        if not scanner.fragment:
+            if b"Profile Not Found" in scanner.content:
                 raise InvalidBattleTag(
                     f"No profile with {handle.desc} {handle.handle} found"
                 )
             raise UnableToFindSR()
 
-        combined = {
-            desc[0].split()[0]: (sr[0], rank_image[0])
-            for desc, sr, rank_image in zip(role_descs, srs, rank_images)
-        }
-
-        sr_list = [
-            int(combined[n][0]) if n in combined else None
-            for n in "Tank Damage Support".split()
-        ]
-        img_list = [
-            combined[n][1] if n in combined else None
-            for n in "Tank Damage Support".split()
-        ]
-
-        res = SR_CACHE[handle.handle] = (TDS(*sr_list), TDS(*img_list))
-
-        return res
-    finally:
-        lock.release()
+        return CareerProfile(
+            validators, headers=result.headers, fragment=scanner.fragment
+        )
+
+
+_SR_SOURCE = HTTPSRSource(BLIZZARD_BASE_URL)
+
+
+def set_sr_source(source):
+    "Replaces the SRSource used by get_sr, e.g. for benchmarks"
+    global _SR_SOURCE
+    _SR_SOURCE = source
+
+
+async def get_sr(handle, *, conditional=False):
+    """Returns the SRs and rank images of the handle.
+
+    If conditional is True, the ETag/Last-Modified and fragment hash stored
+    in the handle are used to raise ProfileUnchanged when the SR part of the
+    profile didn't change since the last call. The stored values are updated
+    on every successful request, and cleared if there is no SR.
+
+    Concurrent requests for the same profile are coalesced into one."""
+
+    if conditional and handle.current_sr:
+        validators = (handle.profile_etag, handle.profile_last_modified)
+    else:
+        validators = (None, None)
+
+    try:
+        profile = await SR_REQUESTS.get(
+            (handle.blizzard_url_type, handle.handle),
+            functools.partial(_SR_SOURCE.fetch_profile, handle, validators),
+            cacheable=lambda profile: not profile.not_modified,
+        )
+
+        if profile.not_modified and profile.validators != validators:
+            # we piggybacked on a conditional request that doesn't apply to us
+            profile = await _SR_SOURCE.fetch_profile(handle, validators)
+
+        if profile.not_modified:
+            raise ProfileUnchanged()
+
+        handle.profile_etag = profile.etag
+        handle.profile_last_modified = profile.last_modified
+
+        unchanged = (
+            conditional
+            and handle.current_sr
+            and profile.fragment_hash == handle.profile_hash
+        )
+        handle.profile_hash = profile.fragment_hash
+        if unchanged:
+            raise ProfileUnchanged()
+
+        res = await profile.parsed()
+        if not res:
+            raise UnableToFindSR()
+    except (UnableToFindSR, InvalidBattleTag):
+        # the stored values must only describe a profile we got an SR from,
+        # otherwise that SR would be considered unchanged when it comes back
+        handle.profile_etag = handle.profile_last_modified = None
+        handle.profile_hash = None
+        raise
+
+    return res
 
 
 def sort_secondaries(user):
@@ -308,11 +308,14 @@ async def save(guild_id):
                 ts += dt.timedelta(days=1)
             cron.next_run = ts
         else:
+            ts = None
             if cron:
                 await run_sync(session.delete, cron)
 
         await run_sync(session.commit)
 
+    orisa._schedule_highscores(guild_id, ts)
+
     async def update():
         for vc in new_gi.managed_voice_categories:
             try: